@@ -14,8 +14,13 @@ Create Database Column
 """
 
 from generic.get_params import get_params
+from generic.db_profiler import profiled
 
+# Column names of each table, keyed by (schema, table)
+columns_cache = {}
 
+
+@profiled
 def create_new_column(db_table, col_name, col_type, *args, **kwargs):
     """
     :Description:
@@ -40,30 +45,132 @@ def create_new_column(db_table, col_name, col_type, *args, **kwargs):
     create_new_column('some_table', 'new_col', 'integer')
     """
 
-    import psycopg2
+    from generic.db_pool import get_connection
 
     params = get_params(*args, **kwargs)
 
-    # Assemble the database metadata
-    conn_str = "host='{0}' dbname='{1}' port='{2}' user='{3}' password='{4}'".format(params['host'],
-                                                                                     params['database'],
-                                                                                     params['port'],
-                                                                                     params['username'],
-                                                                                     params['password'])
-
-    base_command = '''SELECT * FROM ''' + params['schema']
+    base_command = '''ALTER TABLE ''' + params['schema']
 
     # Create the database query
     command = base_command + '."{0}" ADD COLUMN IF NOT EXISTS "{1}" {2}'.format(db_table, col_name, col_type)
 
-    # Connect to the database
-    conn = psycopg2.connect(conn_str)
-    cursor = conn.cursor()
+    # Check out a pooled connection, committed when the block finishes
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
+
+        # Execute the command
+        cursor.execute(command)
+
+    # The cached columns are out of date
+    columns_cache.pop((params['schema'], db_table), None)
+
+
+def get_columns(cursor, schema, db_table, refresh=False):
+    """
+    :Description:
+    Column names of a database table, cached after the first lookup
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    schema: Database schema
+        type: str
+    db_table: Database table name
+        type: str
+    refresh: Ignore the cache?
+        type: bool
+        default: False
+
+    :Returns:
+    Column names
+        type: set
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Example:
+    get_columns(cursor, 'public', 'some_table')
+    """
+
+    key = (schema, db_table)
+
+    if refresh or key not in columns_cache:
+        command = '''SELECT column_name FROM information_schema.columns ''' + \
+                  "WHERE table_schema = '{0}' AND table_name = '{1}'".format(schema, db_table)
+
+        cursor.execute(command)
+
+        columns_cache[key] = {i[0] for i in cursor.fetchall()}
+
+    return set(columns_cache[key])
+
+
+@profiled
+def sync_columns(db_table, df, d_types=None, refresh=False, *args, **kwargs):
+    """
+    :Description:
+    Add every column of a DataFrame that is missing from a database table, in a single ALTER TABLE
+
+    :Params:
+    db_table: Database table name
+        type: str
+    df: Data (only the columns and datatypes are used)
+        type: pandas DataFrame
+    d_types: The datatypes of some columns, overriding the inferred ones
+        type: dict
+        default: None
+    refresh: Look up the table columns again instead of using the cache
+        type: bool
+        default: False
+
+    :Returns:
+    missing: Columns that were added
+        type: list
+
+    :Dependencies:
+    Python3
+    pandas
+    psycopg2
+
+    :Notes:
+    Datatypes are inferred from the DataFrame like in to_db (see infer_schema)
+    All columns are added in one transaction, so the table is only locked once
+
+    :Example:
+    sync_columns('some_table', df, {'new_col': 'integer'})
+    """
+
+    from generic.db_pool import get_connection
+    from generic.to_db import infer_schema
+
+    params = get_params(*args, **kwargs)
+
+    # Check out a pooled connection, committed when the block finishes
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
+
+        existing = get_columns(cursor, params['schema'], db_table, refresh)
+
+        missing = [c for c in df.columns if c not in existing]
+
+        if not missing:
+            return []
+
+        schema = infer_schema(df[missing], d_types)
+
+        adds = ', '.join(['ADD COLUMN IF NOT EXISTS "{0}" {1}'.format(c, schema[c]) for c in missing])
+
+        command = '''ALTER TABLE ''' + '{0}."{1}" {2}'.format(params['schema'], db_table, adds)
+
+        # Execute the command
+        cursor.execute(command)
+
+    columns_cache[(params['schema'], db_table)] = existing | set(missing)
 
-    # Execute the command
-    cursor.execute(command)
+    print('{0}: added {1}'.format(db_table, ', '.join(missing)))
 
-    conn.commit()
+    return missing
 
 
 if __name__ == '__main__':
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+#########################
+Data Cache
+#########################
+
+:Description:
+    Local on-disk cache of closed days for load_data
+
+:Usage:
+    Called from other scripts
+
+:Notes:
+    Each day is stored as a Parquet file at cache_dir/host_port_database/schema/db_table/date_col/YYYY-MM-DD.parquet
+    Files are written to a temporary file and renamed, so readers never see a partly written day
+    Only days that have ended are cached; today is always loaded from the database
+    Call invalidate_cache after rewriting days (drop_from_db, drop_duplicates_from_db, ...)
+
+"""
+
+import os
+import tempfile
+
+from generic.get_params import get_params
+
+
+def cache_folder(cache_dir, params, db_table, date_col):
+    """
+    :Description:
+    Folder of the cached days of a table/date column, separated by database and schema
+
+    :Params:
+    cache_dir: Cache folder
+        type: str
+    params: Database parameters
+        type: dict
+    db_table: Database table name
+        type: str
+    date_col: Datetime column
+        type: str
+
+    :Returns:
+    Folder of the cached files
+        type: str
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    cache_folder('/tmp/cache', get_params(), 'waze_api', 'Date_Time')
+    """
+
+    database = '{0}_{1}_{2}'.format(params['host'], params['port'], params['database'])
+
+    return os.path.join(cache_dir, database, params['schema'], db_table, date_col)
+
+
+def cache_path(cache_dir, params, db_table, date_col, day):
+    """
+    :Description:
+    Location of the cached file for a database/table/date column/day
+
+    :Params:
+    cache_dir: Cache folder
+        type: str
+    params: Database parameters
+        type: dict
+    db_table: Database table name
+        type: str
+    date_col: Datetime column
+        type: str
+    day: Day
+        type: str
+        format: YYYY-MM-DD
+
+    :Returns:
+    Path of the cached file
+        type: str
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    cache_path('/tmp/cache', get_params(), 'waze_api', 'Date_Time', '2019-01-01')
+    """
+
+    return os.path.join(cache_folder(cache_dir, params, db_table, date_col), '{0}.parquet'.format(day))
+
+
+def write_cached(df, path):
+    """
+    :Description:
+    Write a cached day atomically: to a temporary file in the same folder, then renamed over path
+
+    :Params:
+    df: Data
+        type: pandas DataFrame
+    path: Path of the cached file
+        type: str
+
+    :Returns:
+    Nothing, writes the file
+
+    :Dependencies:
+    Python3
+    pandas
+    pyarrow
+
+    :Example:
+    write_cached(df, cache_path('/tmp/cache', get_params(), 'waze_api', 'Date_Time', '2019-01-01'))
+    """
+
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+
+    handle, temp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    os.close(handle)
+
+    try:
+        df.to_parquet(temp, index=False)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def evict_cache(cache_dir, cache_size):
+    """
+    :Description:
+    Remove the least recently used files until the cache fits in cache_size bytes
+
+    :Params:
+    cache_dir: Cache folder
+        type: str
+    cache_size: Maximum size of the cache in bytes
+        type: int
+
+    :Returns:
+    Nothing, removes files from the cache
+
+    :Dependencies:
+    Python3
+
+    :Notes:
+    Files are touched on every read, so the modification time is the last use
+
+    :Example:
+    evict_cache('/tmp/cache', 2 ** 30)
+    """
+
+    files = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if name.endswith('.parquet'):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(i[1] for i in files)
+
+    # Oldest first
+    for _, size, path in sorted(files):
+        if total <= cache_size:
+            break
+
+        os.remove(path)
+        total -= size
+
+
+def invalidate_cache(db_table, date_col='date_time', start=None, end=None, cache_dir=None, *args, **kwargs):
+    """
+    :Description:
+    Remove cached days of a table, e.g. after they were rewritten in the database
+
+    :Params:
+    db_table: Database table name
+        type: str
+    date_col: Datetime column
+        type: str
+        default: date_time
+    start: First day to remove
+        type: str
+        default: None
+        format: YYYY-MM-DD
+    end: Day after the last day to remove
+        type: str
+        default: None
+        format: YYYY-MM-DD
+    cache_dir: Cache folder
+        type: str
+        default: None
+
+    :Returns:
+    Nothing, removes files from the cache
+
+    :Dependencies:
+    Python3
+
+    :Notes:
+    If start is not given, all cached days before end will be removed
+    If end is not given, all cached days after start will be removed
+
+    :Example:
+    drop_from_db(db_table='Waze', date_col='Date_Time', pre_date='2018-01-01', post_date='2018-02-01')
+    invalidate_cache('Waze', 'Date_Time', '2018-01-01', '2018-02-01', cache_dir='/tmp/cache')
+    """
+
+    params = get_params(*args, **kwargs)
+
+    folder = cache_folder(cache_dir, params, db_table, date_col)
+
+    if not os.path.isdir(folder):
+        return
+
+    for name in os.listdir(folder):
+        day = name.split('.')[0]
+
+        # Days are ISO formatted, so string comparison works
+        if (start is None or day >= start[:10]) and (end is None or day < end[:10]):
+            os.remove(os.path.join(folder, name))
+
+
+def load_cached(db_table=None, start=None, end=None, date_col='date_time', chunk_size=100000,
+                time_zone='America/New_York', cache_dir=None, cache_size=2 ** 30, *args, **kwargs):
+    """
+    :Description:
+    Load data from database, reading closed days from the local cache
+
+    :Params:
+    db_table: Database table name
+        type: str
+        default: None
+    start: Start date[time]
+        type: str
+        format: YYYY-MM-DD [HH:MM:SS]
+    end: End date[time]
+        type: str
+        default: None (now)
+        format: YYYY-MM-DD [HH:MM:SS]
+    date_col: Datetime column
+        type: str
+        default: date_time
+    chunk_size: Number of rows to load at a time
+        type: int
+        default: 100000
+    time_zone: Time zone of start/end and of the day boundaries
+        type: str
+        default: America/New_York
+    cache_dir: Cache folder
+        type: str
+        default: None
+    cache_size: Maximum size of the cache in bytes
+        type: int
+        default: 1073741824 (1 GB)
+
+    :Returns:
+    df: Data from given table for specified time frame
+        type: pandas DataFrame
+
+    :Dependencies:
+    Python3
+    pandas
+    pyarrow
+
+    :Notes:
+    Partial days (start/end in the middle of a day) and days that haven't ended are loaded from the database
+
+    :Example:
+    load_cached(db_table='waze_api', start='2019-01-01', end='2019-02-01', date_col='Date_Time', cache_dir='/tmp/cache')
+    """
+
+    import pandas as pd
+    from generic.load_data import load_data_iter
+
+    params = get_params(*args, **kwargs)
+
+    if start is None:
+        raise Exception('Please provide start to use the cache')
+
+    # Day boundaries are in local time
+    today = pd.Timestamp.now(tz=time_zone).tz_localize(None).normalize()
+
+    start = pd.Timestamp(start)
+    if end is None:
+        end = pd.Timestamp.now(tz=time_zone).tz_localize(None)
+    else:
+        end = pd.Timestamp(end)
+
+    def fetch(s, e):
+        return pd.concat(load_data_iter(db_table, s.strftime('%Y-%m-%d %H:%M:%S'), e.strftime('%Y-%m-%d %H:%M:%S'),
+                                        date_col, chunk_size, time_zone, *args, **kwargs), ignore_index=True)
+
+    dfs = []
+    written = False
+
+    while start < end:
+        stop = min(start.normalize() + pd.Timedelta(days=1), end)
+
+        whole_day = (start == start.normalize()) and (stop == start + pd.Timedelta(days=1))
+
+        # Only cache days that are complete and have ended
+        if whole_day and stop <= today:
+            path = cache_path(cache_dir, params, db_table, date_col, start.strftime('%Y-%m-%d'))
+
+            temp = None
+            if os.path.exists(path):
+                try:
+                    temp = pd.read_parquet(path)
+
+                    # Mark the file as recently used
+                    os.utime(path, None)
+                except Exception:
+                    # Unreadable file (e.g. written by an older version without the rename), load it again
+                    temp = None
+
+            if temp is None:
+                temp = fetch(start, stop)
+
+                write_cached(temp, path)
+                written = True
+        else:
+            temp = fetch(start, stop)
+
+        dfs.append(temp)
+
+        start = stop
+
+    if written:
+        evict_cache(cache_dir, cache_size)
+
+    if not dfs:
+        return pd.DataFrame()
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+if __name__ == '__main__':
+
+    print(__doc__)
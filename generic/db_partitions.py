@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+"""
+#########################
+Database Partitions
+#########################
+
+:Description:
+    Create and maintain daily/monthly range partitions of time-series database tables
+
+:Usage:
+    Called from other scripts
+
+:Notes:
+    Partitions are named <table>_YYYYMMDD (day) or <table>_YYYYMM (month)
+    Range reads on the date column only scan the matching partitions
+
+"""
+
+from generic.get_params import get_params
+
+# Partition name format and length of each partition
+intervals = {'day': ('%Y%m%d', {'days': 1}),
+             'month': ('%Y%m', {'months': 1})}
+
+
+def partition_ranges(start, end, interval='day'):
+    """
+    :Description:
+    Partition boundaries covering a time frame
+
+    :Params:
+    start: Start date
+        type: str
+        format: YYYY-MM-DD
+    end: End date
+        type: str
+        format: YYYY-MM-DD
+    interval: Length of each partition
+        type: str
+        options: day, month
+        default: day
+
+    :Returns:
+    ranges: Suffix and start/end of each partition
+        type: list
+        format: [(suffix, YYYY-MM-DD, YYYY-MM-DD), ...]
+
+    :Dependencies:
+    Python3
+    pandas
+
+    :Example:
+    partition_ranges('2019-01-01', '2019-03-01', 'month')
+    """
+
+    import pandas as pd
+
+    fmt, step = intervals[interval]
+    step = pd.DateOffset(**step)
+
+    start = pd.Timestamp(start).normalize()
+    if interval == 'month':
+        start = start.replace(day=1)
+
+    ranges = []
+    while start < pd.Timestamp(end):
+        stop = start + step
+        ranges.append((start.strftime(fmt), start.strftime('%Y-%m-%d'), stop.strftime('%Y-%m-%d')))
+        start = stop
+
+    return ranges
+
+
+def is_partitioned(cursor, schema, db_table):
+    """
+    :Description:
+    Check if a database table is partitioned
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    schema: Database schema
+        type: str
+    db_table: Database table name
+        type: str
+
+    :Returns:
+    Whether or not the table is partitioned
+        type: bool
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Example:
+    is_partitioned(cursor, 'public', 'waze_api')
+    """
+
+    command = '''SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid ''' + \
+              "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = '{0}' AND c.relname = '{1}')".format(
+                  schema, db_table)
+
+    cursor.execute(command)
+
+    return cursor.fetchone()[0]
+
+
+def create_partitioned_table(db_table, date_col='date_time', like_table=None, col_types=None, *args, **kwargs):
+    """
+    :Description:
+    Create a database table partitioned by range on the date column
+
+    :Params:
+    db_table: Database table name
+        type: str
+    date_col: Datetime column to partition on
+        type: str
+        default: date_time
+    like_table: Existing table to copy the columns from
+        type: str
+        default: None
+    col_types: Column names and datatypes (used if like_table isn't given)
+        type: dict
+        format: {column_name_0: type_0, column_name_1: type_1, ...}
+        default: None
+
+    :Returns:
+    Nothing, creates the partitioned table if it doesn't exist
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    Existing tables can't be partitioned in place; create a new table like the old one, copy the data
+    over and rename the tables
+
+    :Example:
+    create_partitioned_table('waze_api_new', 'Date_Time', like_table='waze_api')
+    create_partitioned_table('waze_api', 'Date_Time', col_types={'Date_Time': 'timestamptz', 'ID': 'text'})
+    """
+
+    from generic.db_pool import get_connection
+
+    params = get_params(*args, **kwargs)
+
+    if like_table is not None:
+        columns = 'LIKE {0}."{1}" INCLUDING DEFAULTS'.format(params['schema'], like_table)
+    else:
+        columns = ', '.join(['"{0}" {1}'.format(i, col_types[i]) for i in col_types])
+
+    command = '''CREATE TABLE IF NOT EXISTS ''' + \
+              '{0}."{1}" ({2}) PARTITION BY RANGE ("{3}")'.format(params['schema'], db_table, columns, date_col)
+
+    # Check out a pooled connection, committed when the block finishes
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
+
+        # Execute the command
+        cursor.execute(command)
+
+
+def create_partitions(db_table, start=None, end=None, interval='day', ahead=7, *args, **kwargs):
+    """
+    :Description:
+    Create the partitions of a partitioned table for a time frame, plus future partitions
+
+    :Params:
+    db_table: Database table name
+        type: str
+    start: Start date
+        type: str
+        default: None (today)
+        format: YYYY-MM-DD
+    end: End date
+        type: str
+        default: None (today)
+        format: YYYY-MM-DD
+    interval: Length of each partition
+        type: str
+        options: day, month
+        default: day
+    ahead: Number of future partitions to create after end
+        type: int
+        default: 7
+
+    :Returns:
+    names: Partitions that were created
+        type: list
+
+    :Dependencies:
+    Python3
+    pandas
+    psycopg2
+
+    :Notes:
+    Run daily (e.g. from cron) so inserts never hit a missing partition
+
+    :Example:
+    create_partitions('waze_api', '2019-01-01', interval='day', ahead=14)
+    """
+
+    import pandas as pd
+    from generic.db_pool import get_connection
+
+    params = get_params(*args, **kwargs)
+
+    today = pd.Timestamp.today().normalize()
+
+    if start is None:
+        start = today
+    if end is None:
+        end = today
+
+    if interval == 'month':
+        end = pd.Timestamp(end) + pd.DateOffset(months=ahead + 1)
+    else:
+        end = pd.Timestamp(end) + pd.Timedelta(days=ahead + 1)
+
+    names = []
+
+    # Check out a pooled connection, committed when the block finishes
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
+
+        existing = [i[0] for i in list_partitions(cursor, params['schema'], db_table)]
+
+        for suffix, lo, hi in partition_ranges(start, end, interval):
+            name = '{0}_{1}'.format(db_table, suffix)
+
+            if name in existing:
+                continue
+
+            command = '''CREATE TABLE IF NOT EXISTS ''' + \
+                      '{0}."{1}" PARTITION OF {0}."{2}" FOR VALUES FROM (\'{3}\') TO (\'{4}\')'.format(
+                          params['schema'], name, db_table, lo, hi)
+
+            cursor.execute(command)
+            names.append(name)
+
+    print('{0}: {1} partitions created'.format(db_table, len(names)))
+
+    return names
+
+
+def list_partitions(cursor, schema, db_table):
+    """
+    :Description:
+    List the partitions of a partitioned table
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    schema: Database schema
+        type: str
+    db_table: Database table name
+        type: str
+
+    :Returns:
+    partitions: Name and lower/upper bound of each partition, ordered by lower bound
+        type: list
+        format: [(name, lower, upper), ...]
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    DEFAULT partitions and partitions bounded by MINVALUE/MAXVALUE have no dates and are not listed
+
+    :Example:
+    list_partitions(cursor, 'public', 'waze_api')
+    """
+
+    command = '''SELECT c.relname, b[1], b[2] FROM pg_inherits i ''' + \
+              'JOIN pg_class c ON c.oid = i.inhrelid ' \
+              'JOIN pg_class p ON p.oid = i.inhparent ' \
+              'JOIN pg_namespace n ON n.oid = p.relnamespace, ' \
+              "LATERAL regexp_match(pg_get_expr(c.relpartbound, c.oid), " \
+              "'FROM \\(''([^'']*)''\\) TO \\(''([^'']*)''\\)') b " \
+              "WHERE n.nspname = '{0}' AND p.relname = '{1}' AND b IS NOT NULL ORDER BY b[1]".format(schema, db_table)
+
+    cursor.execute(command)
+
+    return [tuple(i) for i in cursor.fetchall()]
+
+
+def drop_partitions(cursor, schema, db_table, pre_date=None, post_date=None, detach=False):
+    """
+    :Description:
+    Drop (or detach) the partitions that lie completely inside a time frame
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    schema: Database schema
+        type: str
+    db_table: Database table name
+        type: str
+    pre_date: The starting date
+        type: str
+        format: YYYY-MM-DD
+        default: None
+    post_date: The ending date
+        type: str
+        format: YYYY-MM-DD
+        default: None
+    detach: Detach the partitions and keep them as standalone tables instead of dropping them
+        type: bool
+        default: False
+
+    :Returns:
+    names: Partitions that were dropped/detached
+        type: list
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    Rows in partitions that are only partly inside the time frame are left alone
+
+    :Example:
+    drop_partitions(cursor, 'public', 'waze_api', '2018-01-01', '2018-02-01')
+    """
+
+    wheres = []
+    if pre_date is not None:
+        wheres.append("lo::timestamptz >= '{0}'::timestamptz".format(pre_date))
+    if post_date is not None:
+        wheres.append("hi::timestamptz <= '{0}'::timestamptz".format(post_date))
+
+    partitions = list_partitions(cursor, schema, db_table)
+
+    if not partitions:
+        return []
+
+    # Let the database compare the bounds, so time zones are handled the same way as in the queries
+    values = ', '.join(["('{0}', '{1}', '{2}')".format(*i) for i in partitions])
+    command = '''SELECT name FROM (VALUES ''' + values + ') AS p (name, lo, hi)'
+
+    if wheres:
+        command = command + ' WHERE ' + ' AND '.join(wheres)
+
+    cursor.execute(command)
+    names = [i[0] for i in cursor.fetchall()]
+
+    for name in names:
+        if detach:
+            command = '''ALTER TABLE ''' + '{0}."{1}" DETACH PARTITION {0}."{2}"'.format(schema, db_table, name)
+        else:
+            command = '''DROP TABLE ''' + '{0}."{1}"'.format(schema, name)
+
+        cursor.execute(command)
+
+    return names
+
+
+if __name__ == '__main__':
+
+    print(__doc__)
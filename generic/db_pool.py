@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""
+#########################
+Database Pool
+#########################
+
+:Description:
+    Process-wide database connection pools shared by the generic DB helpers
+
+:Usage:
+    Called from other scripts
+
+:Notes:
+    One pool is kept per host/port/database/user, so scripts that call several helpers in a row
+    reuse the same connections instead of connecting each time
+
+"""
+
+import atexit
+import threading
+from contextlib import contextmanager
+
+from generic.db_profiler import stage, get_cursor_factory
+
+# Connection pools, keyed by database parameters
+pools = {}
+lock = threading.Lock()
+
+
+def pool_key(params):
+    """
+    :Description:
+    Key of the connection pool for a set of database parameters
+
+    :Params:
+    params: Database parameters
+        type: dict
+
+    :Returns:
+    Pool key
+        type: tuple
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    key = pool_key(get_params())
+    """
+
+    return params['host'], str(params['port']), params['database'], params['username']
+
+
+def get_pool(params, min_size=1, max_size=20):
+    """
+    :Description:
+    Get (or create) the connection pool for a set of database parameters
+
+    :Params:
+    params: Database parameters
+        type: dict
+    min_size: Number of connections to keep open
+        type: int
+        default: 1
+    max_size: Maximum number of connections
+        type: int
+        default: 20
+
+    :Returns:
+    Connection pool
+        type: psycopg2.pool.ThreadedConnectionPool
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    min_size/max_size only apply when the pool is created
+
+    :Example:
+    pool = get_pool(get_params())
+    """
+
+    from psycopg2.pool import ThreadedConnectionPool
+
+    key = pool_key(params)
+
+    with lock:
+        if key not in pools or pools[key].closed:
+            pools[key] = ThreadedConnectionPool(min_size, max_size,
+                                                host=params['host'],
+                                                dbname=params['database'],
+                                                port=params['port'],
+                                                user=params['username'],
+                                                password=params['password'],
+                                                cursor_factory=get_cursor_factory())
+
+            # getconn raises instead of waiting when every connection is in use, so checkouts wait here
+            pools[key].slots = threading.BoundedSemaphore(max_size)
+
+        return pools[key]
+
+
+def check_connection(conn):
+    """
+    :Description:
+    Check that a pooled connection is still usable
+
+    :Params:
+    conn: Database connection
+        type: psycopg2 connection
+
+    :Returns:
+    Whether or not the connection works
+        type: bool
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Example:
+    ok = check_connection(conn)
+    """
+
+    import psycopg2
+    from psycopg2.extensions import cursor as plain_cursor
+
+    if conn.closed:
+        return False
+
+    try:
+        # Plain cursor so the profiler counts the check as connect time
+        cursor = conn.cursor(cursor_factory=plain_cursor)
+        cursor.execute('SELECT 1')
+        cursor.close()
+        conn.rollback()
+    except psycopg2.Error:
+        return False
+
+    return True
+
+
+@contextmanager
+def get_connection(params, min_size=1, max_size=20):
+    """
+    :Description:
+    Check out a connection from the pool for a set of database parameters
+
+    :Params:
+    params: Database parameters
+        type: dict
+    min_size: Number of connections to keep open
+        type: int
+        default: 1
+    max_size: Maximum number of connections
+        type: int
+        default: 20
+
+    :Returns:
+    Database connection (as a context manager)
+        type: psycopg2 connection
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    The connection is checked with SELECT 1 on checkout and replaced if it is broken
+    Changes are committed when the block finishes and rolled back if it raises
+    The connection always goes back to the pool
+    When all max_size connections are in use, the call waits for one to be returned
+    Checkout time is recorded as connect time when profiling is on (see db_profiler)
+
+    :Example:
+    with get_connection(get_params()) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1')
+    """
+
+    with stage('connect'):
+        pool = get_pool(params, min_size, max_size)
+
+        # Wait for a free connection
+        pool.slots.acquire()
+
+        try:
+            conn = pool.getconn()
+
+            # Replace broken connections
+            if not check_connection(conn):
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except BaseException:
+            pool.slots.release()
+            raise
+
+    try:
+        yield conn
+
+        if not conn.closed:
+            conn.commit()
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        try:
+            pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            pool.slots.release()
+
+
+def close_pools():
+    """
+    :Description:
+    Close every connection of every pool
+
+    :Params:
+    None
+
+    :Returns:
+    Nothing, closes the connections
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Example:
+    close_pools()
+    """
+
+    with lock:
+        for key in list(pools):
+            pools.pop(key).closeall()
+
+
+atexit.register(close_pools)
+
+
+if __name__ == '__main__':
+
+    print(__doc__)
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+
+"""
+#########################
+Database Profiler
+#########################
+
+:Description:
+    Opt-in timing of the generic DB helpers
+
+:Usage:
+    Called from other scripts
+    Turn on with enable_profiling() or the DB_PROFILE=1 environment variable
+
+:Notes:
+    Each helper call records its caller, the SQL fingerprints it ran, rows, bytes copied and
+    connect/execute/fetch/convert times
+    Records are kept in memory (summary, dump) and optionally appended to a JSON lines log
+
+"""
+
+import os
+import re
+import sys
+import json
+import inspect
+import threading
+from time import time
+from functools import wraps
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+enabled = os.environ.get('DB_PROFILE', '') not in ('', '0')
+log_file = os.environ.get('DB_PROFILE_LOG')
+slow_ms = float(os.environ.get('DB_PROFILE_SLOW_MS', 0))
+
+# Last helper calls
+records = deque(maxlen=10000)
+
+# Number of calls per helper in each duration bucket (ms)
+buckets = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 30000, float('inf')]
+histograms = defaultdict(lambda: [0] * len(buckets))
+
+lock = threading.Lock()
+local = threading.local()
+
+# Cursor class used by the connection pool
+cursor_factory = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def enable_profiling(log=None, slow=0):
+    """
+    :Description:
+    Turn on profiling of the generic DB helpers
+
+    :Params:
+    log: JSON lines file to append the records to
+        type: str
+        default: None
+    slow: Only log calls that take at least this many milliseconds
+        type: float
+        default: 0
+
+    :Returns:
+    Nothing
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    enable_profiling(log='/var/log/waze_live_db.jsonl', slow=500)
+    """
+
+    global enabled, log_file, slow_ms
+
+    enabled, log_file, slow_ms = True, log, slow
+
+
+def disable_profiling():
+    """
+    :Description:
+    Turn off profiling of the generic DB helpers
+
+    :Returns:
+    Nothing
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    disable_profiling()
+    """
+
+    global enabled
+
+    enabled = False
+
+
+def fingerprint(sql):
+    """
+    :Description:
+    Normalize a query so calls with different values group together
+
+    :Params:
+    sql: SQL query
+        type: str/bytes
+
+    :Returns:
+    Query with literals replaced by ?
+        type: str
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    fingerprint("SELECT * FROM public.\"waze_api\" WHERE \"Date_Time\" >= '2019-01-01'")
+    """
+
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+
+    sql = re.sub(r"'(?:[^']|'')*'", '?', str(sql))
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\?(, \?)+\)', '(?...)', sql)
+    sql = re.sub(r'\s+', ' ', sql).strip()
+
+    return sql[:300]
+
+
+def find_caller():
+    # First frame outside of the generic package
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = os.path.abspath(frame.f_code.co_filename)
+        if os.path.dirname(path) != here and 'contextlib' not in path:
+            return '{0}:{1} ({2})'.format(path, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+
+    return None
+
+
+def start_call(helper):
+    return {'helper': helper, 'caller': find_caller(), 'start': time(), 'connect': 0, 'execute': 0, 'fetch': 0,
+            'convert': 0, 'rows': 0, 'bytes': 0, 'queries': {}}
+
+
+@contextmanager
+def activate(call):
+    # Make call the current call of this thread
+    parent = getattr(local, 'call', None)
+    local.call = call
+    try:
+        yield call
+    finally:
+        local.call = parent
+
+
+def finish_call(call, error=None):
+    call['total'] = time() - call['start']
+    call['error'] = error
+
+    ms = call['total'] * 1000
+
+    with lock:
+        records.append(call)
+
+        histogram = histograms[call['helper']]
+        for n, bound in enumerate(buckets):
+            if ms <= bound:
+                histogram[n] += 1
+                break
+
+    if log_file is not None and ms >= slow_ms:
+        line = dict(call)
+        line['queries'] = [dict(sql=i, **call['queries'][i]) for i in call['queries']]
+
+        with lock:
+            with open(log_file, 'a') as outfile:
+                outfile.write(json.dumps(line, default=str) + '\n')
+
+
+def add_time(stage, seconds, sql=None, rows=None, size=None):
+    """
+    :Description:
+    Add a timing to the helper call running in this thread
+
+    :Params:
+    stage: connect, execute, fetch or convert
+        type: str
+    seconds: Duration
+        type: float
+    sql: Query (grouped by fingerprint)
+        type: str
+        default: None
+    rows: Rows returned/affected
+        type: int
+        default: None
+    size: Bytes transferred
+        type: int
+        default: None
+
+    :Returns:
+    Nothing
+
+    :Dependencies:
+    Python3
+    """
+
+    call = getattr(local, 'call', None)
+
+    if call is None:
+        return
+
+    call[stage] += seconds
+
+    if rows is not None and rows > 0:
+        call['rows'] += rows
+    if size is not None:
+        call['bytes'] += size
+
+    if sql is not None:
+        query = call['queries'].setdefault(fingerprint(sql), {'count': 0, 'seconds': 0, 'rows': 0})
+        query['count'] += 1
+        query['seconds'] += seconds
+        if rows is not None and rows > 0:
+            query['rows'] += rows
+
+
+@contextmanager
+def stage(name):
+    """
+    :Description:
+    Time a block of code as a stage (connect, execute, fetch, convert) of the current helper call
+
+    :Params:
+    name: Stage
+        type: str
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    with stage('convert'):
+        df = pd.DataFrame(records)
+    """
+
+    if not enabled:
+        yield
+        return
+
+    t0 = time()
+    try:
+        yield
+    finally:
+        add_time(name, time() - t0)
+
+
+def profiled(func):
+    """
+    :Description:
+    Decorator that records a helper call when profiling is on
+
+    :Params:
+    func: Helper (function or generator function)
+        type: function
+
+    :Returns:
+    Wrapped helper
+        type: function
+
+    :Dependencies:
+    Python3
+
+    :Notes:
+    Helpers called by another profiled helper are counted in the outer call
+
+    :Example:
+    @profiled
+    def load_data(...):
+    """
+
+    if inspect.isgeneratorfunction(func):
+        def generate(call, generator):
+            error = None
+
+            try:
+                while True:
+                    # Only time the generator while it runs, not while the caller works on a chunk
+                    with activate(call):
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            break
+                    yield item
+            except GeneratorExit:
+                raise
+            except BaseException as e:
+                error = repr(e)
+                raise
+            finally:
+                generator.close()
+                finish_call(call, error)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled or getattr(local, 'call', None) is not None:
+                return func(*args, **kwargs)
+
+            # Find the caller now, the generator runs later from whatever iterates over it
+            return generate(start_call(func.__name__), func(*args, **kwargs))
+
+        return wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled or getattr(local, 'call', None) is not None:
+            return func(*args, **kwargs)
+
+        call = start_call(func.__name__)
+        error = None
+
+        try:
+            with activate(call):
+                return func(*args, **kwargs)
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            finish_call(call, error)
+
+    return wrapper
+
+
+def get_cursor_factory():
+    """
+    :Description:
+    Cursor class that times execute/fetch/copy for the profiler
+
+    :Returns:
+    Cursor class
+        type: psycopg2.extensions.cursor subclass
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    Used by db_pool for every pooled connection; costs a flag check when profiling is off
+
+    :Example:
+    conn.cursor(cursor_factory=get_cursor_factory())
+    """
+
+    global cursor_factory
+
+    if cursor_factory is not None:
+        return cursor_factory
+
+    from psycopg2.extensions import cursor
+
+    class ProfilingCursor(cursor):
+        def execute(self, query, vars=None):
+            if not enabled:
+                return super(ProfilingCursor, self).execute(query, vars)
+
+            t0 = time()
+            try:
+                return super(ProfilingCursor, self).execute(query, vars)
+            finally:
+                # Rows of queries are counted when they are fetched
+                add_time('execute', time() - t0, query, self.rowcount if self.description is None else None)
+
+        def executemany(self, query, vars_list):
+            if not enabled:
+                return super(ProfilingCursor, self).executemany(query, vars_list)
+
+            t0 = time()
+            try:
+                return super(ProfilingCursor, self).executemany(query, vars_list)
+            finally:
+                # Rows of queries are counted when they are fetched
+                add_time('execute', time() - t0, query, self.rowcount if self.description is None else None)
+
+        def fetchone(self):
+            if not enabled:
+                return super(ProfilingCursor, self).fetchone()
+
+            t0 = time()
+            row = super(ProfilingCursor, self).fetchone()
+            add_time('fetch', time() - t0, rows=int(row is not None))
+            return row
+
+        def fetchmany(self, size=None):
+            if not enabled:
+                return super(ProfilingCursor, self).fetchmany(size) if size is not None else \
+                    super(ProfilingCursor, self).fetchmany()
+
+            t0 = time()
+            if size is None:
+                rows = super(ProfilingCursor, self).fetchmany()
+            else:
+                rows = super(ProfilingCursor, self).fetchmany(size)
+            add_time('fetch', time() - t0, rows=len(rows))
+            return rows
+
+        def fetchall(self):
+            if not enabled:
+                return super(ProfilingCursor, self).fetchall()
+
+            t0 = time()
+            rows = super(ProfilingCursor, self).fetchall()
+            add_time('fetch', time() - t0, rows=len(rows))
+            return rows
+
+        def copy_expert(self, sql, file, size=8192):
+            if not enabled:
+                return super(ProfilingCursor, self).copy_expert(sql, file, size)
+
+            # Bytes copied, from the file position
+            try:
+                position = file.tell()
+            except Exception:
+                position = None
+
+            t0 = time()
+            try:
+                return super(ProfilingCursor, self).copy_expert(sql, file, size)
+            finally:
+                try:
+                    copied = abs(file.tell() - position) if position is not None else None
+                except Exception:
+                    copied = None
+
+                add_time('execute', time() - t0, sql, self.rowcount, copied)
+
+    cursor_factory = ProfilingCursor
+
+    return cursor_factory
+
+
+def summary():
+    """
+    :Description:
+    Call count, duration percentiles and time split of each helper
+
+    :Returns:
+    stats: One row per helper
+        type: pandas DataFrame
+
+    :Dependencies:
+    Python3
+    pandas
+
+    :Example:
+    print(summary())
+    """
+
+    import pandas as pd
+
+    with lock:
+        df = pd.DataFrame(list(records))
+
+    if df.empty:
+        return df
+
+    df['ms'] = df['total'] * 1000
+
+    stats = df.groupby('helper').agg(calls=('ms', 'size'), p50_ms=('ms', 'median'),
+                                     p95_ms=('ms', lambda x: x.quantile(.95)), max_ms=('ms', 'max'),
+                                     connect_s=('connect', 'sum'), execute_s=('execute', 'sum'),
+                                     fetch_s=('fetch', 'sum'), convert_s=('convert', 'sum'),
+                                     rows=('rows', 'sum'), bytes=('bytes', 'sum'))
+
+    return stats.sort_values('p95_ms', ascending=False)
+
+
+def dump(path=None):
+    """
+    :Description:
+    Dump the recorded calls and histograms
+
+    :Params:
+    path: JSON file to write to
+        type: str
+        default: None
+
+    :Returns:
+    Recorded calls and per-helper histograms
+        type: dict
+        format: {'buckets_ms': [...], 'histograms': {helper: [...]}, 'records': [...]}
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    dump('/tmp/db_profile.json')
+    """
+
+    with lock:
+        data = {'buckets_ms': [str(i) for i in buckets],
+                'histograms': {i: list(histograms[i]) for i in histograms},
+                'records': [dict(i) for i in records]}
+
+    if path is not None:
+        with open(path, 'w') as outfile:
+            json.dump(data, outfile, default=str, indent=1)
+
+    return data
+
+
+def reset():
+    """
+    :Description:
+    Clear the recorded calls and histograms
+
+    :Returns:
+    Nothing
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    reset()
+    """
+
+    with lock:
+        records.clear()
+        histograms.clear()
+
+
+if __name__ == '__main__':
+
+    print(__doc__)
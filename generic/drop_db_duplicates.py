@@ -12,9 +12,12 @@ Drop duplicate records from specified database table
 """
 
 from generic.get_params import get_params
+from generic.db_profiler import profiled
 
 
-def drop_duplicates_from_db(db_table=None, groupby_cols=None, keep_last=True, *args, **kwargs):
+@profiled
+def drop_duplicates_from_db(db_table=None, groupby_cols=None, keep_last=True, date_col=None, start=None, end=None,
+                            batch_size=None, *args, **kwargs):
     """
     :Description:
     Drop duplicate records from specified database table
@@ -29,17 +32,43 @@ def drop_duplicates_from_db(db_table=None, groupby_cols=None, keep_last=True, *a
     keep_last: keep the last duplicated entry?
         type: bool
         default: True
-    returns: Nothing
+    date_col: Date column used to restrict the search to a time frame
+        type: str
+        default: None
+    start: Only check rows on or after this date[time]
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    end: Only check rows before this date[time]
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    batch_size: Maximum number of rows to delete per transaction
+        type: int
+        default: None (all at once)
+    returns: Number of rows deleted
+        type: int
 
     :Dependencies:
     Python3
     psycopg2
 
+    :Notes:
+    Duplicates are found with ROW_NUMBER() OVER (PARTITION BY groupby_cols) and removed with DELETE ... USING
+    The first/last entry is by physical position (table partition, then ctid)
+    With date_col and start/end, only rows in [start, end) are scanned, so an index on date_col keeps it fast;
+    rows with a copy outside of the time frame are not considered duplicates
+    With batch_size, the rows to delete are found once and stored in a temporary table,
+    then deleted batch_size at a time, each batch committed separately so locks are held briefly;
+    the key columns are stored too and must still match, so a row moved by a concurrent update is left alone
+
     :Example:
     drop_duplicates_from_db(db_table='Waze', groupby_cols=['ID', 'Date_Time'], keep_last=True)
+    drop_duplicates_from_db(db_table='Waze', groupby_cols=['ID', 'Date_Time'], date_col='Date_Time',
+                            start='2019-01-01', end='2019-01-02', batch_size=50000)
     """
 
-    import psycopg2
+    from generic.db_pool import get_connection
 
     params = get_params(*args, **kwargs)
 
@@ -49,29 +78,77 @@ def drop_duplicates_from_db(db_table=None, groupby_cols=None, keep_last=True, *a
     else:
         cols = '", "'.join([groupby_cols])
 
+    # The kept row is numbered 1
     if keep_last:
-        keep = 'MAX'
+        keep = 'DESC'
+    else:
+        keep = 'ASC'
+
+    # Restrict the search to the time frame
+    wheres = []
+    if date_col is not None and start is not None:
+        wheres.append('"{0}" >= \'{1}\''.format(date_col, start))
+    if date_col is not None and end is not None:
+        wheres.append('"{0}" < \'{1}\''.format(date_col, end))
+
+    # Same restriction on the deleted rows
+    t_wheres = ''.join(' AND t.' + i for i in wheres)
+
+    if wheres:
+        wheres = ' WHERE ' + ' AND '.join(wheres)
     else:
-        keep = 'MIN'
+        wheres = ''
+
+    # Rows to delete
+    # ctids are only unique within a partition, so rows are identified by (tableoid, ctid)
+    dupes = '''SELECT ''' + 'tableoid AS tid, ctid AS rid, "{2}" FROM (SELECT tableoid, ctid, "{2}", ' \
+                            'ROW_NUMBER() OVER (PARTITION BY "{2}" ORDER BY tableoid {3}, ctid {3}) AS rn ' \
+                            'FROM {0}."{1}"{4}) AS r WHERE rn > 1'.format(params['schema'], db_table, cols, keep, wheres)
 
     # Build command
-    command = '''DELETE FROM ''' + '{0}."{1}" WHERE ctid NOT IN (SELECT {2}(ctid) FROM {0}."{1}" ' \
-                                   'GROUP BY "{3}");'.format(params['schema'], db_table, keep, cols)
-
-    # Assemble the database metadata
-    conn_str = "host='{0}' dbname='{1}' port='{2}' user='{3}' password='{4}'".format(params['host'],
-                                                                                     params['database'],
-                                                                                     params['port'],
-                                                                                     params['username'],
-                                                                                     params['password'])
-
-    # Connect to database
-    conn = psycopg2.connect(conn_str)
-    cursor = conn.cursor()
-
-    # Execute command
-    cursor.execute(command)
-    conn.commit()
+    command = '''DELETE FROM ''' + '{0}."{1}" AS t USING ({2}) AS d ' \
+                                   'WHERE t.tableoid = d.tid AND t.ctid = d.rid{3}'.format(
+                                       params['schema'], db_table, dupes, t_wheres)
+
+    deleted = 0
+
+    # Check out a pooled connection, committed when the block finishes
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
+
+        if batch_size is None:
+            # Execute command
+            cursor.execute(command)
+            deleted = cursor.rowcount
+        else:
+            # Find the duplicates once, numbered for batching
+            cursor.execute('''DROP TABLE IF EXISTS ''' + 'drop_duplicates_batch')
+            cursor.execute('''CREATE TEMPORARY TABLE ''' + 'drop_duplicates_batch AS SELECT ROW_NUMBER() OVER () AS n, d.* '
+                                                           'FROM ({0}) AS d'.format(dupes))
+            cursor.execute('''CREATE INDEX ''' + 'ON drop_duplicates_batch (n)')
+            cursor.execute('''SELECT ''' + 'count(*) FROM drop_duplicates_batch')
+            total = cursor.fetchone()[0]
+            conn.commit()
+
+            # The key columns must still match in case a row was moved since
+            matches = ''.join(' AND t."{0}" IS NOT DISTINCT FROM d."{0}"'.format(i) for i in cols.split('", "'))
+
+            try:
+                for lower in range(0, total, int(batch_size)):
+                    cursor.execute('''DELETE FROM ''' + '{0}."{1}" AS t USING drop_duplicates_batch AS d '
+                                                        'WHERE d.n > {2} AND d.n <= {3} '
+                                                        'AND t.tableoid = d.tid AND t.ctid = d.rid{4}{5}'.format(
+                                                            params['schema'], db_table, lower,
+                                                            lower + int(batch_size), matches, t_wheres))
+                    deleted += cursor.rowcount
+                    conn.commit()
+            finally:
+                conn.rollback()
+                cursor.execute('''DROP TABLE IF EXISTS ''' + 'drop_duplicates_batch')
+
+    print('{0}: {1} duplicates deleted'.format(db_table, deleted))
+
+    return deleted
 
 
 if __name__ == '__main__':
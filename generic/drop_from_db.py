@@ -14,9 +14,12 @@ Drop Database Entries
 """
 
 from generic.get_params import get_params
+from generic.db_profiler import profiled
 
 
-def drop_from_db(db_table=None, date_col='date_time', pre_date=None, post_date=None, *args, **kwargs):
+@profiled
+def drop_from_db(db_table=None, date_col='date_time', pre_date=None, post_date=None, batch=None, batch_size=None,
+                 pause=0, partitions=False, detach=False, *args, **kwargs):
     """
     :Description:
     Drops all entries between the start/end dates from the specified database table
@@ -36,7 +39,24 @@ def drop_from_db(db_table=None, date_col='date_time', pre_date=None, post_date=N
         type: str
         format: YYYY-MM-DD
         default: None
-    returns: Nothing
+    batch: Length of the time slice deleted per transaction
+        type: str
+        format: pandas Timedelta string (1D, 6H, 1H, ...)
+        default: None
+    batch_size: Maximum number of rows deleted per transaction
+        type: int
+        default: None
+    pause: Seconds to wait between batches
+        type: float
+        default: 0
+    partitions: Drop whole partitions inside the time frame instead of deleting their rows
+        type: bool
+        default: False
+    detach: Detach those partitions instead of dropping them (only used with partitions)
+        type: bool
+        default: False
+    returns: Number of rows deleted
+        type: int
 
     :Dependencies:
     Python3
@@ -44,47 +64,111 @@ def drop_from_db(db_table=None, date_col='date_time', pre_date=None, post_date=N
 
     :Notes:
     Will grab all data if start/end dates are not specified
+    With batch, the range is deleted one time slice at a time (needs both pre_date and post_date)
+    With batch_size, rows are deleted by (tableoid, ctid), batch_size at a time
+    Each batch is committed separately, which keeps locks short and lets WAL be recycled between batches
+    With partitions, partitions of a partitioned table (see db_partitions) that lie completely inside the
+    time frame are dropped first; only the rows of partly covered partitions are deleted
 
     :Example:
     drop_from_db(db_table='Waze', date_col='Date_Time', start='2018-01-01', end='2018-02-01')
+    drop_from_db(db_table='Waze', date_col='Date_Time', pre_date='2018-01-01', post_date='2018-04-01', batch='1D',
+                 pause=1)
     """
 
-    import psycopg2
+    from time import sleep, time
+    from generic.db_pool import get_connection
 
     params = get_params(*args, **kwargs)
 
     print('{0}\n{1}\t-\t{2}\n'.format(db_table, pre_date, post_date))
 
+    def where(start, end):
+        wheres = []
+        if start is not None:
+            wheres.append('"{0}" >= \'{1}\''.format(date_col, start))
+        if end is not None:
+            wheres.append('"{0}" < \'{1}\''.format(date_col, end))
+
+        if wheres:
+            return ' WHERE ' + ' AND '.join(wheres)
+        return ''
+
+    def execute(command):
+        # Check out a pooled connection, committed when the block finishes
+        with get_connection(params) as conn:
+            cursor = conn.cursor()
+
+            # Execute command
+            cursor.execute(command)
+
+            return cursor.rowcount
+
+    # Drop whole partitions first, the deletes below then only touch the edges
+    if partitions:
+        from generic.db_partitions import is_partitioned, drop_partitions
+
+        with get_connection(params) as conn:
+            cursor = conn.cursor()
+
+            if is_partitioned(cursor, params['schema'], db_table):
+                names = drop_partitions(cursor, params['schema'], db_table, pre_date, post_date, detach)
+
+                print('{0} partitions {1}: {2}'.format(len(names), 'detached' if detach else 'dropped',
+                                                       ', '.join(names)))
+
     # Build command
-    if (pre_date is None) and (post_date is None):
-        command = '''DELETE FROM ''' + '{0}."{1}"'.format(params['schema'], db_table)
-    elif pre_date is None:
-        command = '''DELETE FROM ''' + '{0}."{1}" WHERE "{2}" < \'{3}\''.format(params['schema'], db_table, date_col,
-                                                                                post_date)
-    elif post_date is None:
-        command = '''DELETE FROM ''' + '{0}."{1}" WHERE "{2}" >= \'{3}\''.format(params['schema'], db_table, date_col,
-                                                                                 pre_date)
+    base_command = '''DELETE FROM ''' + '{0}."{1}"'.format(params['schema'], db_table)
+
+    if batch is None and batch_size is None:
+        return execute(base_command + where(pre_date, post_date))
+
+    # Build the batches
+    if batch is not None:
+        from generic.load_data import split_range
+
+        if pre_date is None or post_date is None:
+            raise Exception('Please provide both pre_date and post_date to delete in time slices')
+
+        batches = [(i, base_command + where(*i)) for i in split_range(pre_date, post_date, batch)]
     else:
-        command = '''DELETE FROM ''' + '{0}."{1}" WHERE "{2}" >= \'{3}\' AND "{2}" < \'{4}\''.format(params['schema'],
-                                                                                                     db_table,
-                                                                                                     date_col,
-                                                                                                     pre_date,
-                                                                                                     post_date)
-
-    # Assemble the database metadata
-    conn_str = "host='{0}' dbname='{1}' port='{2}' user='{3}' password='{4}'".format(params['host'],
-                                                                                     params['database'],
-                                                                                     params['port'],
-                                                                                     params['username'],
-                                                                                     params['password'])
-
-    # Connect to database
-    conn = psycopg2.connect(conn_str)
-    cursor = conn.cursor()
-
-    # Execute command
-    cursor.execute(command)
-    conn.commit()
+        batches = None
+
+    deleted = 0
+    n = 0
+
+    while True:
+        t0 = time()
+
+        if batches is not None:
+            if n == len(batches):
+                break
+
+            label, command = batches[n]
+            num = execute(command)
+            label = '{0} - {1}'.format(*label)
+        else:
+            # ctids are only unique within a partition, so match on tableoid too and keep the range on the delete
+            wheres = where(pre_date, post_date)
+            command = base_command + wheres + (' AND' if wheres else ' WHERE') + \
+                ' (tableoid, ctid) IN (SELECT tableoid, ctid FROM {0}."{1}"{2} LIMIT {3})'.format(
+                    params['schema'], db_table, wheres, int(batch_size))
+            num = execute(command)
+            label = 'batch {0}'.format(n + 1)
+
+        deleted += num
+        n += 1
+
+        print('{0}: {1} rows deleted in {2:.2f}s ({3} total)'.format(label, num, time() - t0, deleted))
+
+        # Stops when the last ctid batch wasn't full
+        if batches is None and num < batch_size:
+            break
+
+        if pause:
+            sleep(pause)
+
+    return deleted
 
 
 if __name__ == '__main__':
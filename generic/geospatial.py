@@ -16,7 +16,6 @@ Geospatial
 
 """
 
-import math
 import numpy as np
 
 
@@ -44,28 +43,14 @@ def get_coords(row, geom_col, coord_type):
     Returns coordinates ('x' or 'y') of a geometry (Point, LineString or Polygon) as a list
     (if geometry is LineString or Polygon).
     Can handle also MultiGeometries.
+    Use get_coord_buffers to get the coordinates of a whole GeoSeries at once.
     """
-    # Get geometry
-    geom = row[geom_col]
 
-    # Check the geometry type
-    gtype = geom.geom_type
+    x, y, _, _, bokeh_x, bokeh_y = get_coord_buffers([row[geom_col]])
 
-    # "Normal" geometries
-    # -------------------
+    coords = bokeh_x[0] if coord_type == 'x' else bokeh_y[0]
 
-    if gtype == "Point":
-        return get_point_coords(geom, coord_type)
-    elif gtype == "LineString":
-        return list(get_line_coords(geom, coord_type))
-    elif gtype == "Polygon":
-        return list(get_poly_coords(geom, coord_type))
-
-    # Multi geometries
-    # ----------------
-
-    else:
-        return list(multi_geom_handler(geom, coord_type, gtype))
+    return coords if np.ndim(coords) == 0 else list(coords)
 
 
 def get_line_coords(geometry, coord_type):
@@ -86,29 +71,130 @@ def multi_geom_handler(multi_geometry, coord_type, geom_type):
     Function for handling multi-geometries. Can be MultiPoint, MultiLineString or MultiPolygon.
     Returns a list of coordinates where all parts of Multi-geometries are merged into a single list.
     Individual geometries are separated with np.nan which is how Bokeh wants them.
+    """
+
+    x, y, _, _, bokeh_x, bokeh_y = get_coord_buffers([multi_geometry])
+
+    coords = bokeh_x[0] if coord_type == 'x' else bokeh_y[0]
+
+    # Return the coordinates
+    return np.append(coords, np.nan)
+
+
+def get_parts(geometry, interiors=False, parts=None):
+    """
+    Returns the coordinate arrays (N x 2) of every part of a geometry, walking Multi* and collections recursively.
+    Polygons contribute their exterior, plus their interior rings if interiors is True.
+    """
+
+    if parts is None:
+        parts = []
+
+    if geometry is None or geometry.is_empty:
+        return parts
+
+    gtype = geometry.geom_type
+
+    if gtype == 'Polygon':
+        rings = [geometry.exterior] + (list(geometry.interiors) if interiors else [])
+        for ring in rings:
+            parts.append(np.asarray(ring.coords)[:, :2])
+    elif gtype in ('Point', 'LineString', 'LinearRing'):
+        parts.append(np.asarray(geometry.coords)[:, :2])
+    else:
+        for part in geometry.geoms:
+            get_parts(part, interiors, parts)
+
+    return parts
+
+
+def get_coord_buffers(geometries, interiors=False, transform=None):
+    """
+    :Description:
+    Walk a GeoSeries once and return its coordinates as flat buffers and as Bokeh-ready arrays
+
+    :Params:
+    geometries: Geometries (Point, LineString, Polygon, Multi* or GeometryCollection)
+        type: geopandas GeoSeries/sequence of shapely geometries
+    interiors: Include the interior rings of polygons as extra parts
+        type: bool
+        default: False
+    transform: Function applied to the flat x, y arrays before the Bokeh arrays are built
+        type: function
+        default: None
+        format: x, y = transform(x, y)
+
+    :Returns:
+    x, y: Coordinates of every vertex
+        type: numpy arrays
+    part_offsets: Start of each part in x/y, plus the total length at the end
+        type: numpy array (int64)
+    geom_offsets: Start of each geometry in the parts, plus the number of parts at the end
+        type: numpy array (int64)
+    bokeh_x, bokeh_y: One entry per geometry, parts separated with np.nan (a float for Points)
+        type: lists
+
+    :Dependencies:
+    Python3
+    numpy
+    shapely
+
+    :Notes:
+    Every part is collected once and copied once, so the cost is linear in the number of vertices
+    The Bokeh arrays are views into one NaN-separated buffer
     # Bokeh documentation regarding the Multi-geometry issues can be found here (it is an open issue)
     # https://github.com/bokeh/bokeh/issues/2321
+
+    :Example:
+    x, y, part_offsets, geom_offsets, gdf['x'], gdf['y'] = get_coord_buffers(gdf['geometry'])
     """
 
-    for i, part in enumerate(multi_geometry):
-        # On the first part of the Multi-geometry initialize the coord_array (np.array)
-        if i == 0:
-            if geom_type == "MultiPoint":
-                coord_arrays = np.append(get_point_coords(part, coord_type), np.nan)
-            elif geom_type == "MultiLineString":
-                coord_arrays = np.append(get_line_coords(part, coord_type), np.nan)
-            elif geom_type == "MultiPolygon":
-                coord_arrays = np.append(get_poly_coords(part, coord_type), np.nan)
+    parts, n_parts, points = [], [], []
+    for geom in geometries:
+        n = len(parts)
+        get_parts(geom, interiors, parts)
+        n_parts.append(len(parts) - n)
+        points.append(geom is not None and geom.geom_type == 'Point' and not geom.is_empty)
+
+    part_lens = np.array([len(i) for i in parts], dtype=np.int64)
+
+    part_offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    np.cumsum(part_lens, out=part_offsets[1:])
+
+    geom_offsets = np.zeros(len(n_parts) + 1, dtype=np.int64)
+    np.cumsum(n_parts, out=geom_offsets[1:])
+
+    if parts:
+        xy = np.concatenate(parts)
+        x, y = xy[:, 0].astype(float), xy[:, 1].astype(float)
+    else:
+        x, y = np.empty(0), np.empty(0)
+
+    if transform is not None:
+        x, y = transform(x, y)
+
+    # One NaN after every part
+    index = np.arange(len(x)) + np.repeat(np.arange(len(parts)), part_lens)
+
+    flat_x = np.full(len(x) + len(parts), np.nan)
+    flat_y = np.full(len(y) + len(parts), np.nan)
+    flat_x[index] = x
+    flat_y[index] = y
+
+    # Bokeh range of each geometry, without its trailing NaN
+    starts = part_offsets[geom_offsets[:-1]] + geom_offsets[:-1]
+    ends = part_offsets[geom_offsets[1:]] + geom_offsets[1:] - (geom_offsets[1:] > geom_offsets[:-1])
+
+    bokeh_x, bokeh_y = [], []
+    for start, end, point in zip(starts.tolist(), ends.tolist(), points):
+        if point:
+            bokeh_x.append(float(flat_x[start]))
+            bokeh_y.append(float(flat_y[start]))
         else:
-            if geom_type == "MultiPoint":
-                coord_arrays = np.concatenate([coord_arrays, np.append(get_point_coords(part, coord_type), np.nan)])
-            elif geom_type == "MultiLineString":
-                coord_arrays = np.concatenate([coord_arrays, np.append(get_line_coords(part, coord_type), np.nan)])
-            elif geom_type == "MultiPolygon":
-                coord_arrays = np.concatenate([coord_arrays, np.append(get_poly_coords(part, coord_type), np.nan)])
+            bokeh_x.append(flat_x[start:end])
+            bokeh_y.append(flat_y[start:end])
 
-    # Return the coordinates
-    return coord_arrays
+    return x, y, part_offsets, geom_offsets, bokeh_x, bokeh_y
 
 
 def lat_to_y(a, radius=6378137.0):
@@ -118,49 +204,218 @@ def lat_to_y(a, radius=6378137.0):
 
     :Params:
     a: Latitude
-        type: int/float
+        type: int/float/array
     radius: Radius of the Earth at latitude
         type: float
         default: 6378137.0 (NYC)
 
     :Returns:
-    String in snake_case
-        type: float
+    Web Mercator y (same shape as a)
+        type: float/numpy array
 
     :Dependencies:
     Python3
+    numpy
 
     :Example:
     y = lat_to_y(40.700700)
+    y = lat_to_y(np.array([40.700700, 40.771225]))
     """
 
-    return math.log(math.tan(math.pi / 4 + math.radians(a) / 2)) * radius
+    return np.log(np.tan(np.pi / 4 + np.radians(a) / 2)) * radius
 
 
 def lon_to_x(a, radius=6378137.0):
     """
     :Description:
-    Convert latitude to Web Mercator (y)
+    Convert longitude to Web Mercator (x)
 
     :Params:
-    a: Latitude
-        type: int/float
+    a: Longitude
+        type: int/float/array
     radius: Radius of the Earth at latitude
         type: float
         default: 6378137.0 (NYC)
 
     :Returns:
-    String in snake_case
+    Web Mercator x (same shape as a)
+        type: float/numpy array
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Example:
+    x = lon_to_x(-73.873578)
+    x = lon_to_x(np.array([-73.873578, -73.940000]))
+    """
+
+    return np.radians(a) * radius
+
+
+def to_mercator(lon, lat, radius=6378137.0):
+    """
+    :Description:
+    Convert flat longitude/latitude arrays to Web Mercator in one call
+
+    :Params:
+    lon: Longitudes
+        type: array-like
+    lat: Latitudes
+        type: array-like
+    radius: Radius of the Earth at latitude
         type: float
+        default: 6378137.0 (NYC)
+
+    :Returns:
+    x, y: Web Mercator coordinates
+        type: tuple of numpy arrays
 
     :Dependencies:
     Python3
+    numpy
 
     :Example:
-    y = lat_to_y(40.700700)
+    x, y = to_mercator(df['lon'].values, df['lat'].values)
     """
 
-    return math.radians(a) * radius
+    return lon_to_x(np.asarray(lon, dtype=float), radius), lat_to_y(np.asarray(lat, dtype=float), radius)
+
+
+def ragged_to_flat(rows):
+    """
+    :Description:
+    Join per-geometry coordinate arrays into one flat array with offsets
+
+    :Params:
+    rows: Coordinate arrays (or scalars for points), one per geometry
+        type: sequence
+
+    :Returns:
+    values: All coordinates
+        type: numpy array
+    offsets: Start of each geometry in values, plus the total length at the end
+        type: numpy array (int64)
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Example:
+    values, offsets = ragged_to_flat(gdf['x'])
+    """
+
+    rows = [np.atleast_1d(np.asarray(i, dtype=float)).ravel() for i in rows]
+
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(i) for i in rows], out=offsets[1:])
+
+    values = np.concatenate(rows) if rows else np.empty(0)
+
+    return values, offsets
+
+
+def flat_to_ragged(values, offsets):
+    """
+    :Description:
+    Split a flat coordinate array back into per-geometry arrays
+
+    :Params:
+    values: All coordinates
+        type: numpy array
+    offsets: Start of each geometry in values, plus the total length at the end
+        type: numpy array
+
+    :Returns:
+    One array per geometry (views into values)
+        type: list of numpy arrays
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Example:
+    gdf['x'] = flat_to_ragged(x, offsets)
+    """
+
+    return np.split(values, np.asarray(offsets)[1:-1])
+
+
+def project_ragged(values, offsets=None, coord='lat', radius=6378137.0):
+    """
+    :Description:
+    Project per-geometry coordinates to Web Mercator with a single vectorized call
+
+    :Params:
+    values: Flat coordinates (with offsets) or one array/scalar per geometry (without offsets)
+        type: array-like/sequence
+    offsets: Start of each geometry in values, plus the total length at the end
+        type: array-like
+        default: None
+    coord: Coordinate type (lat or lon)
+        type: str
+        default: lat
+    radius: Radius of the Earth at latitude
+        type: float
+        default: 6378137.0 (NYC)
+
+    :Returns:
+    Projected coordinates, one entry per geometry
+        type: list of numpy arrays (floats for scalar inputs)
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Example:
+    gdf['x'] = project_ragged(gdf['x'], coord='lon')
+    gdf['y'] = project_ragged(y, offsets, coord='lat')
+    """
+
+    f = lat_to_y if coord == 'lat' else lon_to_x
+
+    if offsets is not None:
+        return flat_to_ragged(f(np.asarray(values, dtype=float), radius), offsets)
+
+    rows = list(values)
+    scalar = [np.ndim(i) == 0 for i in rows]
+
+    flat, offsets = ragged_to_flat(rows)
+
+    result = flat_to_ragged(f(flat, radius), offsets)
+
+    # Points keep returning a single value
+    return [float(j[0]) if i else j for i, j in zip(scalar, result)]
+
+
+def project_geometries(geometries, radius=6378137.0):
+    """
+    :Description:
+    Project every vertex of a GeoSeries (EPSG:4326) to Web Mercator at once
+
+    :Params:
+    geometries: Geometries in longitude/latitude
+        type: geopandas GeoSeries
+    radius: Radius of the Earth at latitude
+        type: float
+        default: 6378137.0 (NYC)
+
+    :Returns:
+    x, y: Web Mercator coordinates, one entry per geometry (Bokeh patches/multi_line format)
+        type: tuple of lists
+
+    :Dependencies:
+    Python3
+    numpy
+    shapely
+
+    :Example:
+    gdf['x'], gdf['y'] = project_geometries(gdf['geometry'])
+    """
+
+    x, y, _, _, bokeh_x, bokeh_y = get_coord_buffers(geometries, transform=lambda x, y: to_mercator(x, y, radius))
+
+    return bokeh_x, bokeh_y
 
 
 def l2x(x):
@@ -168,11 +423,7 @@ def l2x(x):
     Wrapper function for lon_to_x
     """
 
-    for row in x:
-        try:
-            return np.asarray([lon_to_x(i) for i in row])
-        except:
-            return lon_to_x(row)
+    return lon_to_x(np.asarray(x, dtype=float))
 
 
 def l2y(x):
@@ -180,47 +431,45 @@ def l2y(x):
     Wrapper function for lat_to_y
     """
 
-    for row in x:
-        try:
-            return np.asarray([lat_to_y(i) for i in row])
-        except:
-            return lat_to_y(row)
+    return lat_to_y(np.asarray(x, dtype=float))
 
 
 def to_x(x):
     """
-    Vectorizes l2x
+    Projects a Series of longitudes (or longitude arrays) to Web Mercator x
     """
 
-    f = np.vectorize(l2x)
+    result = np.empty(len(x), dtype=object)
+    for i, j in enumerate(project_ragged(x.values, coord='lon')):
+        result[i] = j
 
-    return f(x.values)
+    return result
 
 
 def to_y(x):
     """
-    Vectorizes l2y
+    Projects a Series of latitudes (or latitude arrays) to Web Mercator y
     """
 
-    f = np.vectorize(l2y)
+    result = np.empty(len(x), dtype=object)
+    for i, j in enumerate(project_ragged(x.values, coord='lat')):
+        result[i] = j
 
-    return f(x.values)
+    return result
 
 
 def to_xy(row, coord='lat'):
     if coord == 'lat':
-        try:
-            return np.asarray([lat_to_y(i) for i in row])
-        except:
-            return lat_to_y(row)
+        return lat_to_y(np.asarray(row, dtype=float))
     else:
-        try:
-            return np.asarray([lon_to_x(i) for i in row])
-        except:
-            return lon_to_x(row)
+        return lon_to_x(np.asarray(row, dtype=float))
 
 
 def calculate_earth_radius(B):
+    """
+    Returns the radius of the Earth (km) at latitude B (radians). Works elementwise on arrays.
+    """
+
     r1 = 6378.137  # equator
     r2 = 6356.752  # poles
     return np.sqrt(
@@ -229,34 +478,340 @@ def calculate_earth_radius(B):
 
 def haversine(loc1, loc2):
     """
-    Calculate the great circle distance between two points
+    :Description:
+    Calculate the great circle distance between two points (or two N x 2 arrays of points, elementwise)
     on the earth (specified in decimal degrees)
+
+    :Params:
+    loc1: Longitude, latitude
+        type: tuple/array
+        format: (lon, lat) or N x 2
+    loc2: Longitude, latitude
+        type: tuple/array
+        format: (lon, lat) or N x 2
+
+    :Returns:
+    Distance in km, using the radius of the Earth at the mean latitude of each pair
+        type: float/numpy array
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Example:
+    d = haversine((-73.873578, 40.771225), (-73.940000, 40.700700))
+    d = haversine(xy[:-1], xy[1:])
     """
 
+    loc1, loc2 = np.asarray(loc1, dtype=float), np.asarray(loc2, dtype=float)
+
     # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(np.radians, [loc1[0], loc1[1], loc2[0], loc2[1]])
+    lon1, lat1 = np.radians(loc1[..., 0]), np.radians(loc1[..., 1])
+    lon2, lat2 = np.radians(loc2[..., 0]), np.radians(loc2[..., 1])
 
     # haversine formula
     dlon = lon2 - lon1
     dlat = lat2 - lat1
     a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arcsin(np.sqrt(a))
-
-    B = np.mean([lat1, lat2])
+    c = 2 * np.arcsin(np.sqrt(np.minimum(a, 1)))
 
-    r = calculate_earth_radius(B)
+    r = calculate_earth_radius((lat1 + lat2) / 2)
 
     return c * r
 
 
+def haversine_path(coords, offsets=None):
+    """
+    :Description:
+    Length of the segments of a path, or total length of each path in a flat buffer
+
+    :Params:
+    coords: Longitude, latitude of every vertex
+        type: numpy array
+        format: N x 2
+    offsets: Start of each path in coords, plus the total length at the end (see get_coord_buffers)
+        type: array-like
+        default: None
+
+    :Returns:
+    Segment lengths in km (without offsets) or the length of each path in km (with offsets)
+        type: numpy array
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Notes:
+    Segments between the last vertex of a path and the first vertex of the next one are not counted
+
+    :Example:
+    seg = haversine_path(np.asarray(line.coords))
+    lengths = haversine_path(np.column_stack([x, y]), part_offsets)
+    """
+
+    coords = np.asarray(coords, dtype=float)
+
+    seg = haversine(coords[:-1], coords[1:]) if len(coords) > 1 else np.empty(0)
+
+    if offsets is None:
+        return seg
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    # Drop the segments that join two paths
+    starts = offsets[1:-1]
+    seg[starts[(starts > 0) & (starts < len(coords))] - 1] = 0
+
+    cum = np.concatenate([[0], np.cumsum(seg)])
+
+    # Length of path i is cum[end - 1] - cum[start], 0 for paths with fewer than 2 vertices
+    ends = np.maximum(offsets[1:] - 1, offsets[:-1])
+
+    return cum[np.minimum(ends, len(seg))] - cum[np.minimum(offsets[:-1], len(seg))]
+
+
+def haversine_matrix(loc1, loc2=None, block_size=None):
+    """
+    :Description:
+    Pairwise great circle distances between two sets of points
+
+    :Params:
+    loc1: Longitude, latitude
+        type: numpy array
+        format: N x 2
+    loc2: Longitude, latitude (loc1 if None)
+        type: numpy array
+        format: M x 2
+        default: None
+    block_size: Number of rows of loc1 computed at a time, to bound the temporary arrays
+        type: int
+        default: None (all at once)
+
+    :Returns:
+    Distances in km
+        type: numpy array
+        format: N x M
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Notes:
+    Without block_size the temporaries take about 8x the memory of the result
+    With block_size they take about 8 x block_size x M floats
+
+    :Example:
+    d = haversine_matrix(stops, block_size=1000)
+    """
+
+    loc1 = np.asarray(loc1, dtype=float)
+    loc2 = loc1 if loc2 is None else np.asarray(loc2, dtype=float)
+
+    if block_size is None:
+        return haversine(loc1[:, None, :], loc2[None, :, :])
+
+    out = np.empty((len(loc1), len(loc2)))
+    for start in range(0, len(loc1), block_size):
+        out[start:start + block_size] = haversine(loc1[start:start + block_size, None, :], loc2[None, :, :])
+
+    return out
+
+
 def calculate_length(x):
-    x = np.array(x.coords)
+    """
+    Returns the length (km) of a LineString
+    """
+
+    x = np.asarray(x.coords)[:, :2]
+
+    return float(haversine_path(x).sum())
+
+
+def calculate_lengths(geometries):
+    """
+    :Description:
+    Length of every geometry of a GeoSeries (EPSG:4326) in one vectorized pass
+
+    :Params:
+    geometries: Geometries in longitude/latitude
+        type: geopandas GeoSeries/sequence of shapely geometries
+
+    :Returns:
+    Length of each geometry in km (sum of its parts, 0 for points)
+        type: numpy array
+
+    :Dependencies:
+    Python3
+    numpy
+    shapely
+
+    :Example:
+    gdf['length'] = calculate_lengths(gdf['geometry'])
+    """
+
+    x, y, part_offsets, geom_offsets, _, _ = get_coord_buffers(geometries)
+
+    parts = haversine_path(np.column_stack([x, y]), part_offsets)
+
+    cum = np.concatenate([[0], np.cumsum(parts)])
+
+    return cum[geom_offsets[1:]] - cum[geom_offsets[:-1]]
+
+
+def project_points_to_line(points, line, block_size=4000000):
+    """
+    Returns the closest point on one line (lon, lat), the distance along the line and the distance to the line (m)
+    and the segment index for every point (N x 2). See project_points_to_lines.
+    """
+
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+    # MultiLineString: closest part, measured along the parts in order
+    if hasattr(line, 'geoms'):
+        n = len(points)
+        snapped = np.full((n, 2), np.nan)
+        along, dist = np.full(n, np.nan), np.full(n, np.nan)
+        segment = np.full(n, -1, dtype=np.int64)
+
+        before, segments = 0, 0
+        for part in line.geoms:
+            result = project_points_to_line(points, part, block_size)
+            closer = result[3] < np.where(np.isnan(dist), np.inf, dist)
+
+            snapped[closer] = result[0][closer]
+            along[closer] = result[1][closer] + before
+            segment[closer] = result[2][closer] + segments
+            dist[closer] = result[3][closer]
+
+            coords = np.asarray(part.coords, dtype=float).reshape(-1, 2)
+            before += haversine_path(coords).sum() * 1000 if len(coords) > 1 else 0
+            segments += max(len(coords) - 1, 1) if len(coords) else 0
+
+        return snapped, along, segment, dist
+
+    line = np.asarray(getattr(line, 'coords', line), dtype=float).reshape(-1, 2)
+
+    n = len(points)
+    snapped = np.full((n, 2), np.nan)
+    along, dist = np.full(n, np.nan), np.full(n, np.nan)
+    segment = np.full(n, -1, dtype=np.int64)
+
+    if not len(line) or not n:
+        return snapped, along, segment, dist
+
+    # A single vertex is a zero-length segment
+    if len(line) == 1:
+        line = np.vstack([line, line])
+
+    start, end = line[:-1], line[1:]
+
+    # Length of the line before each segment (m)
+    before = np.concatenate([[0], np.cumsum(haversine_path(line))])[:-1] * 1000
+
+    step = max(1, block_size // len(start))
+    for offset in range(0, n, step):
+        p = points[offset:offset + step]
+
+        # Local plane around each point: degrees of longitude shrink by cos(latitude)
+        scale = np.cos(np.radians(p[:, 1]))[:, None]
+
+        x0, y0 = (start[:, 0] - p[:, [0]]) * scale, start[:, 1] - p[:, [1]]
+        dx, dy = (end[:, 0] - start[:, 0]) * scale, np.broadcast_to(end[:, 1] - start[:, 1], x0.shape)
+
+        length = dx ** 2 + dy ** 2
+        t = np.divide(-(x0 * dx + y0 * dy), length, out=np.zeros_like(length), where=length > 0)
+        t = np.clip(t, 0, 1)
+
+        # Closest segment of each point
+        best = np.argmin((x0 + t * dx) ** 2 + (y0 + t * dy) ** 2, axis=1)
+        t = t[np.arange(len(p)), best]
+
+        closest = start[best] + t[:, None] * (end[best] - start[best])
+
+        rows = slice(offset, offset + len(p))
+        snapped[rows] = closest
+        segment[rows] = best
+        along[rows] = before[best] + haversine(start[best], closest) * 1000
+        dist[rows] = haversine(p, closest) * 1000
+
+    return snapped, along, segment, dist
+
+
+def project_points_to_lines(points, lines, line_index=None, block_size=4000000):
+    """
+    :Description:
+    Snap many points to polylines (map matching): closest point, distance along the line and segment index
+
+    :Params:
+    points: Longitude, latitude of the points
+        type: numpy array
+        format: N x 2
+    lines: Polylines in longitude/latitude
+        type: list of LineStrings/coordinate arrays, or a GeoSeries
+    line_index: Line to snap each point to (positions in lines)
+        type: array-like of int (length N)
+        default: None (snap every point to every line)
+    block_size: Maximum number of point/segment pairs computed at a time
+        type: int
+        default: 4000000
+
+    :Returns:
+    snapped: Closest point on the line (lon, lat)
+        type: numpy array (N x 2, or N x L x 2 without line_index)
+    along: Distance from the start of the line to the closest point (m, haversine)
+        type: numpy array (N, or N x L without line_index)
+    segment: Segment of the line holding the closest point (-1 for no point/line)
+        type: numpy array (N, or N x L without line_index)
+    dist: Distance from the point to the line (m, haversine)
+        type: numpy array (N, or N x L without line_index)
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Notes:
+    The closest point is found in a local plane around each point (longitudes scaled by cos(latitude)),
+    which is exact enough for segments up to a few km; distances are then measured with haversine
+    Points are processed line by line, so memory is bounded by block_size whatever the number of points
+    For a MultiLineString, each point is snapped to its closest part; along and segment count the parts in order
+    (along adds the lengths of the previous parts, without the gaps between parts)
+
+    :Example:
+    snapped, along, segment, dist = project_points_to_lines(pings[['lon', 'lat']].values, gdf['geometry'],
+                                                            line_index=pings['route_id'].values)
+    """
+
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    lines = list(lines)
+
+    if line_index is None:
+        snapped = np.full((len(points), len(lines), 2), np.nan)
+        along, dist = np.full((len(points), len(lines)), np.nan), np.full((len(points), len(lines)), np.nan)
+        segment = np.full((len(points), len(lines)), -1, dtype=np.int64)
+
+        for i, line in enumerate(lines):
+            snapped[:, i], along[:, i], segment[:, i], dist[:, i] = project_points_to_line(points, line, block_size)
+
+        return snapped, along, segment, dist
+
+    line_index = np.asarray(line_index).ravel()
+
+    snapped = np.full((len(points), 2), np.nan)
+    along, dist = np.full(len(points), np.nan), np.full(len(points), np.nan)
+    segment = np.full(len(points), -1, dtype=np.int64)
+
+    # Group the points by line
+    order = np.argsort(line_index, kind='stable')
+    values, starts = np.unique(line_index[order], return_index=True)
+
+    for value, rows in zip(values, np.split(order, starts[1:])):
+        if value < 0 or value >= len(lines):
+            continue
 
-    dists = 0
-    for i in range(1, len(x)):
-        dists += haversine(x[i][:2], x[i - 1][:2])
+        snapped[rows], along[rows], segment[rows], dist[rows] = project_points_to_line(points[rows], lines[value],
+                                                                                       block_size)
 
-    return dists
+    return snapped, along, segment, dist
 
 
 if __name__ == '__main__':
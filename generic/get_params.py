@@ -11,10 +11,116 @@ Get Params
 :Usage:
     Called from other scripts
 
+:Notes:
+    Parsed files are cached in memory and only re-read when they change
+    Environment variables (DB_HOST, DB_PORT, DB_PASSWORD, ...) override the values from file
+
 """
 
+import os
+from time import time
+
+# Parsed parameter files, keyed by path
+# Each entry is [modification time, time of the last check, parameters]
+cache = {}
+
+# Seconds between checks for changes to a cached file
+recheck = 30
+
+# Parameters that can be set with environment variables
+param_keys = ['host', 'database', 'schema', 'port', 'username', 'password']
+
+
+def read_params_file(path):
+    """
+    :Description:
+    Read a tab-separated parameter file, using the in-memory cache when possible
+
+    :Params:
+    path: Path of the parameter file
+        type: str
+
+    :Returns:
+    Parameters
+        type: dict
+
+    :Dependencies:
+    Python3
+
+    :Notes:
+    The file is only checked for changes every recheck seconds, and only re-parsed when its modification time changes
+
+    :Example:
+    params = read_params_file('/home/admin/db_params.txt')
+    """
+
+    now = time()
+    entry = cache.get(path)
+
+    if entry is not None and now - entry[1] < recheck:
+        return dict(entry[2])
+
+    mtime = os.stat(path).st_mtime
+
+    if entry is not None and entry[0] == mtime:
+        entry[1] = now
+        return dict(entry[2])
+
+    with open(path) as infile:
+        params = infile.read().strip()
+
+    params = params.split('\n')
+    params = {i.split('\t')[0].strip(): i.split('\t')[1].strip() for i in params}
+
+    cache[path] = [mtime, now, params]
+
+    return dict(params)
+
+
+def apply_env(params, env_prefix='DB_'):
+    """
+    :Description:
+    Override parameters with environment variables and convert them to their types
+
+    :Params:
+    params: Database parameters
+        type: dict
+    env_prefix: Prefix of the environment variables
+        type: str
+        default: DB_
+
+    :Returns:
+    Database parameters
+        type: dict
+
+    :Dependencies:
+    Python3
+
+    :Notes:
+    DB_HOST overrides host, DB_PORT overrides port, and so on
+    port is converted to int
 
-def get_params(param_file='db_params.txt', user_file=None, param_loc=None, user_loc=None, *args, **kwargs):
+    :Example:
+    params = apply_env({'host': 'localhost'})
+    """
+
+    if env_prefix is not None:
+        keys = set(params) | set(param_keys)
+
+        for key in keys:
+            value = os.environ.get(env_prefix + key.upper())
+
+            if value is not None:
+                params[key] = value
+
+    if 'port' in params and str(params['port']).isdigit():
+        params['port'] = int(params['port'])
+
+    return params
+
+
+def get_params(param_file='db_params.txt', user_file=None, param_loc=None, user_loc=None, env_prefix='DB_',
+               *args, **kwargs):
     """
     :Description:
     Load the database parameters from file
@@ -26,6 +132,9 @@ def get_params(param_file='db_params.txt', user_file=None, param_loc=None, user_
     param_loc: Location of database parameter file
         type: str
         default: None
+    env_prefix: Prefix of the environment variables that override the parameters (None to ignore them)
+        type: str
+        default: DB_
     returns: Database parameters
         type: dict
         format:{'host': 'host',
@@ -39,28 +148,32 @@ def get_params(param_file='db_params.txt', user_file=None, param_loc=None, user_
 
     :Notes:
     param_loc defaults to home directory
+    If the parameter file doesn't exist, the parameters are taken from the environment variables only
 
     :Example:
     params = get_params(param_loc='/home/admin/params')
     """
 
-    import os
-
     if param_loc is None:
         param_loc = os.path.expanduser('~')
 
-    with open(os.path.join(param_loc, param_file)) as infile:
-        params = infile.read().strip()
+    path = os.path.join(param_loc, param_file)
 
-    params = params.split('\n')
-    params = {i.split('\t')[0].strip(): i.split('\t')[1].strip() for i in params}
+    try:
+        params = read_params_file(path)
+    except FileNotFoundError:
+        # Fall back on the environment variables
+        # Only the parameter variables count, not other DB_* settings like DB_PROFILE
+        if env_prefix is None or not any(env_prefix + i.upper() in os.environ for i in param_keys):
+            raise
+        params = {}
 
     # if user is specified, use that user 
     if user_file is not None:
         user = get_user(user_file=user_file, user_loc=user_loc)
         params.update(user)
 
-    return params
+    return apply_env(params, env_prefix)
 
 
 def get_user(user_file='db_user.txt', user_loc=None):
@@ -91,18 +204,10 @@ def get_user(user_file='db_user.txt', user_loc=None):
     user = get_user(user_loc='/home/admin/params')
     """
 
-    import os
-
     if user_loc is None:
         user_loc = os.path.expanduser('~')
 
-    with open(os.path.join(user_loc, user_file)) as infile:
-        params = infile.read().strip()
-
-    params = params.split('\n')
-    params = {i.split('\t')[0].strip(): i.split('\t')[1].strip() for i in params}
-
-    return params
+    return read_params_file(os.path.join(user_loc, user_file))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+"""
+#########################
+Index Advisor
+#########################
+
+:Description:
+    Check the indexes of a table against the time-range/key queries of the generic DB helpers
+
+:Usage:
+    Called from other scripts
+
+:Notes:
+    load_data, drop_from_db and the live dashboard filter on a datetime column (Date_Time) and often a key (ID)
+    Append-only timestamp columns get a BRIN index, lookup keys get a btree index
+    Queries are timed with EXPLAIN (ANALYZE, BUFFERS) before and after creating the indexes
+
+"""
+
+import re
+from generic.get_params import get_params
+from generic.db_profiler import profiled
+
+
+def get_indexes(cursor, schema, db_table):
+    """
+    :Description:
+    List the indexes of a database table
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    schema: Database schema
+        type: str
+    db_table: Database table name
+        type: str
+
+    :Returns:
+    indexes: Name, method and columns of each index
+        type: list
+        format: [(name, method, [column_0, column_1, ...]), ...]
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Example:
+    get_indexes(cursor, 'public', 'waze_api')
+    """
+
+    command = '''SELECT indexname, indexdef FROM pg_indexes ''' + \
+              "WHERE schemaname = '{0}' AND tablename = '{1}'".format(schema, db_table)
+
+    cursor.execute(command)
+
+    indexes = []
+    for name, definition in cursor.fetchall():
+        match = re.search(r'USING (\w+) \((.*)\)', definition)
+
+        if match is None:
+            continue
+
+        cols = [i.strip().split(' ')[0].strip('"') for i in match.group(2).split(',')]
+        indexes.append((name, match.group(1), cols))
+
+    return indexes
+
+
+def get_correlation(cursor, schema, db_table, col):
+    """
+    :Description:
+    Correlation between the physical row order and the values of a column, from pg_stats
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    schema: Database schema
+        type: str
+    db_table: Database table name
+        type: str
+    col: Column name
+        type: str
+
+    :Returns:
+    Correlation (-1 to 1), None if the table hasn't been analyzed
+        type: float
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    Append-only timestamp columns are close to 1, which is where BRIN indexes work well
+
+    :Example:
+    get_correlation(cursor, 'public', 'waze_api', 'Date_Time')
+    """
+
+    command = '''SELECT correlation FROM pg_stats ''' + \
+              "WHERE schemaname = '{0}' AND tablename = '{1}' AND attname = '{2}'".format(schema, db_table, col)
+
+    cursor.execute(command)
+    records = cursor.fetchall()
+
+    if not records:
+        return None
+
+    return records[0][0]
+
+
+def explain(cursor, command):
+    """
+    :Description:
+    Run a query with EXPLAIN (ANALYZE, BUFFERS) and return its timing
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    command: SQL query
+        type: str
+
+    :Returns:
+    stats: Execution time (ms), planning time (ms), shared buffers hit/read and the top plan node
+        type: dict
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    The query is actually run, so only use it with SELECT queries
+
+    :Example:
+    explain(cursor, 'SELECT * FROM public."waze_api" WHERE "ID" = \'1\'')
+    """
+
+    import json
+
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + command)
+
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]
+
+    return {'execution_ms': plan['Execution Time'],
+            'planning_ms': plan['Planning Time'],
+            'shared_hit': plan['Plan'].get('Shared Hit Blocks', 0),
+            'shared_read': plan['Plan'].get('Shared Read Blocks', 0),
+            'node': plan['Plan']['Node Type']}
+
+
+def has_unique_index(cursor, schema, db_table, cols):
+    """
+    :Description:
+    Check if a table has a valid unique index on exactly a set of columns (what ON CONFLICT needs)
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    schema: Database schema
+        type: str
+    db_table: Database table name
+        type: str
+    cols: Column names, in any order
+        type: list
+
+    :Returns:
+    Whether or not the index exists
+        type: bool
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    Read only, so it's safe to call from the load paths; partial and invalid indexes don't count
+
+    :Example:
+    has_unique_index(cursor, 'public', 'internal_status_dashboard', ['script', 'location'])
+    """
+
+    names = ', '.join(["'{0}'".format(i) for i in sorted(cols)])
+
+    command = '''SELECT EXISTS (SELECT 1 FROM pg_index i ''' + \
+              'JOIN pg_class c ON c.oid = i.indrelid ' \
+              'JOIN pg_namespace n ON n.oid = c.relnamespace ' \
+              "WHERE n.nspname = '{0}' AND c.relname = '{1}' AND i.indisunique AND i.indisvalid " \
+              'AND i.indpred IS NULL AND i.indnatts = {2} ' \
+              'AND ARRAY(SELECT a.attname::text FROM pg_attribute a WHERE a.attrelid = c.oid ' \
+              'AND a.attnum = ANY(i.indkey) ORDER BY a.attname::text) = ARRAY[{3}]::text[])'.format(schema, db_table,
+                                                                                                   len(cols), names)
+
+    cursor.execute(command)
+
+    return cursor.fetchone()[0]
+
+
+@profiled
+def advise_indexes(db_table=None, date_col='date_time', key_cols=None, create=False, start=None, end=None,
+                   correlation=0.9, *args, **kwargs):
+    """
+    :Description:
+    Check the indexes of a table against the time-range/key queries, optionally create the missing ones
+    and report the query timings before and after
+
+    :Params:
+    db_table: Database table name
+        type: str
+        default: None
+    date_col: Datetime column
+        type: str
+        default: date_time
+    key_cols: Lookup columns
+        type: list
+        default: None
+    create: Create the suggested indexes?
+        type: bool
+        default: False
+    start: Start of the time frame of the test query
+        type: str
+        default: None (one day ago)
+        format: YYYY-MM-DD [HH:MM:SS]
+    end: End of the time frame of the test query
+        type: str
+        default: None (now)
+        format: YYYY-MM-DD [HH:MM:SS]
+    correlation: Minimum correlation of date_col with the row order to suggest BRIN instead of btree
+        type: float
+        default: 0.9
+
+    :Returns:
+    report: Suggested indexes and query timings
+        type: dict
+        format: {'suggested': [command_0, ...], 'before': {query: stats}, 'after': {query: stats}}
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    Indexes are created with CREATE INDEX CONCURRENTLY, so writes aren't blocked
+    Existing indexes count if the column is their leading column
+
+    :Example:
+    advise_indexes('waze_api', date_col='Date_Time', key_cols=['ID'])
+    advise_indexes('waze_api', date_col='Date_Time', key_cols=['ID'], create=True)
+    """
+
+    from generic.db_pool import get_connection
+
+    params = get_params(*args, **kwargs)
+    schema = params['schema']
+
+    if key_cols is None:
+        key_cols = []
+    elif type(key_cols) != list:
+        key_cols = [key_cols]
+
+    # Time frame of the test query
+    if start is None:
+        lower = "now() - interval '1 day'"
+    else:
+        lower = "'{0}'".format(start)
+    if end is None:
+        upper = 'now()'
+    else:
+        upper = "'{0}'".format(end)
+
+    queries = {'range': '''SELECT * FROM ''' + '{0}."{1}" WHERE "{2}" >= {3} AND "{2}" < {4}'.format(schema, db_table,
+                                                                                                  date_col, lower,
+                                                                                                  upper)}
+
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
+
+        indexes = get_indexes(cursor, schema, db_table)
+        leading = [i[2][0] for i in indexes]
+
+        # Lookup queries use a value that exists in the table
+        for col in key_cols:
+            command = '''SELECT "{0}" FROM {1}."{2}" WHERE "{0}" IS NOT NULL LIMIT 1'''.format(col, schema, db_table)
+            cursor.execute(command)
+            records = cursor.fetchall()
+
+            if records:
+                queries[col] = '''SELECT * FROM ''' + \
+                               '{0}."{1}" WHERE "{2}" = \'{3}\''.format(schema, db_table, col, records[0][0])
+
+        suggested = []
+
+        if date_col not in leading:
+            corr = get_correlation(cursor, schema, db_table, date_col)
+
+            if corr is not None and corr >= correlation:
+                method = 'brin'
+            else:
+                method = 'btree'
+
+            suggested.append('''CREATE INDEX CONCURRENTLY IF NOT EXISTS ''' +
+                             '"{0}_{1}_{2}" ON {3}."{0}" USING {2} ("{1}")'.format(db_table, date_col, method, schema))
+
+        for col in key_cols:
+            if col not in leading:
+                suggested.append('''CREATE INDEX CONCURRENTLY IF NOT EXISTS ''' +
+                                 '"{0}_{1}_btree" ON {2}."{0}" USING btree ("{1}")'.format(db_table, col, schema))
+
+        before = {i: explain(cursor, queries[i]) for i in queries}
+
+    print('{0}."{1}" indexes:'.format(schema, db_table))
+    for name, method, cols in indexes:
+        print('\t{0} ({1}): {2}'.format(name, method, ', '.join(cols)))
+
+    print('Suggested:')
+    for command in suggested:
+        print('\t' + command)
+    if not suggested:
+        print('\tNothing')
+
+    after = {}
+
+    if create and suggested:
+        with get_connection(params) as conn:
+            # CREATE INDEX CONCURRENTLY can't run inside a transaction
+            conn.autocommit = True
+
+            try:
+                cursor = conn.cursor()
+
+                for command in suggested:
+                    cursor.execute(command)
+
+                cursor.execute('''ANALYZE ''' + '{0}."{1}"'.format(schema, db_table))
+
+                after = {i: explain(cursor, queries[i]) for i in queries}
+            finally:
+                conn.autocommit = False
+
+    print('Query timings:')
+    for i in queries:
+        line = '\t{0}: {1:.1f} ms ({2}, {3} hit/{4} read)'.format(i, before[i]['execution_ms'], before[i]['node'],
+                                                                   before[i]['shared_hit'], before[i]['shared_read'])
+        if i in after:
+            line += ' -> {0:.1f} ms ({1}, {2} hit/{3} read)'.format(after[i]['execution_ms'], after[i]['node'],
+                                                                    after[i]['shared_hit'], after[i]['shared_read'])
+        print(line)
+
+    return {'suggested': suggested, 'before': before, 'after': after}
+
+
+@profiled
+def create_unique_index(db_table=None, cols=None, dedupe=False, keep_last=True, *args, **kwargs):
+    """
+    :Description:
+    One-off migration: create the unique index that INSERT ... ON CONFLICT needs, without blocking writes
+
+    :Params:
+    db_table: Database table name
+        type: str
+        default: None
+    cols: Columns that identify a row
+        type: list
+        default: None
+    dedupe: Drop duplicate rows first (see drop_duplicates_from_db)
+        type: bool
+        default: False
+    keep_last: Keep the last duplicated entry when deduping
+        type: bool
+        default: True
+
+    :Returns:
+    name: Name of the index (None if a matching unique index already existed)
+        type: str
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    The index is built with CREATE UNIQUE INDEX CONCURRENTLY, which fails if the table still has duplicates
+    An invalid index left by a failed build is dropped before trying again
+    Run it once per table, not from the load paths (upsert_to_db, update_internal_status_db_batch)
+
+    :Example:
+    create_unique_index('internal_status_dashboard', ['script', 'location'], dedupe=True)
+    create_unique_index('Waze', ['ID', 'Date_Time'], dedupe=True)
+    """
+
+    from generic.db_pool import get_connection
+
+    params = get_params(*args, **kwargs)
+    schema = params['schema']
+
+    if type(cols) != list:
+        cols = [cols]
+
+    name = '{0}_{1}_key'.format(db_table, '_'.join(cols))
+
+    if dedupe:
+        from generic.drop_db_duplicates import drop_duplicates_from_db
+
+        drop_duplicates_from_db(db_table, cols, keep_last, None, None, None, None, *args, **kwargs)
+
+    with get_connection(params) as conn:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction
+        conn.autocommit = True
+
+        try:
+            cursor = conn.cursor()
+
+            if has_unique_index(cursor, schema, db_table, cols):
+                print('{0}."{1}" already has a unique index on ({2})'.format(schema, db_table, ', '.join(cols)))
+                return None
+
+            # Leftover of a failed concurrent build
+            cursor.execute('''SELECT NOT i.indisvalid FROM pg_index i ''' +
+                           "JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_namespace n ON n.oid = c.relnamespace "
+                           "WHERE n.nspname = '{0}' AND c.relname = '{1}'".format(schema, name))
+            records = cursor.fetchall()
+            if records and records[0][0]:
+                cursor.execute('''DROP INDEX CONCURRENTLY ''' + '{0}."{1}"'.format(schema, name))
+
+            cursor.execute('''CREATE UNIQUE INDEX CONCURRENTLY ''' +
+                           '"{0}" ON {1}."{2}" ({3})'.format(name, schema, db_table,
+                                                             ', '.join(['"{0}"'.format(i) for i in cols])))
+        finally:
+            conn.autocommit = False
+
+    print('{0}."{1}": created unique index {2}'.format(schema, db_table, name))
+
+    return name
+
+
+if __name__ == '__main__':
+
+    print(__doc__)
@@ -14,10 +14,281 @@ Load Data
 """
 
 from generic.get_params import get_params
+from generic.db_profiler import profiled, stage
 
+# Per-table buffers used by load_new_data
+buffers = {}
 
+# Column kind of PostgreSQL type OIDs, used to type the COPY output (anything else is read as text)
+pg_types = {16: 'bool', 20: 'int64', 21: 'int16', 23: 'int32', 26: 'int64', 700: 'float32', 701: 'float64',
+            1700: 'float64', 1082: 'date', 1114: 'timestamp', 1184: 'timestamptz'}
+
+
+def build_command(schema, db_table, start=None, end=None, date_col='date_time', time_zone='America/New_York',
+                  since=None, key_col=None, since_key=None):
+    """
+    :Description:
+    Build the SELECT query for a table and time frame
+
+    :Params:
+    schema: Database schema
+        type: str
+    db_table: Database table name
+        type: str
+    start: Start date[time]
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    end: End date[time]
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    date_col: Datetime column
+        type: str
+        default: date_time
+    time_zone: Time zone of start/end
+        type: str
+        default: America/New_York
+    since: Only select rows newer than this date_col value (watermark)
+        type: str/datetime
+        default: None
+    key_col: Tie-break column for rows sharing the watermark, rows are then ordered by (date_col, key_col)
+        type: str
+        default: None
+    since_key: Last seen key_col value at the watermark
+        type: str/int
+        default: None
+
+    :Returns:
+    command: SQL query
+        type: str
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    command = build_command('public', 'some_table', start='2019-01-01')
+    """
+
+    command = '''SELECT * FROM ''' + '{0}."{1}"'.format(schema, db_table)
+
+    # Create the database query
+    if start is None and end is None:
+        pass
+    elif start is None:
+        command = command + ' WHERE "{1}" < \'{2} {3}\''.format(db_table, date_col, end, time_zone)
+    elif end is None:
+        command = command + ' WHERE "{1}" >= \'{2} {3}\''.format(db_table, date_col, start, time_zone)
+    else:
+        command = command + ' WHERE "{1}" >= \'{2} {4}\' AND "{1}" < \'{3} {4}\''.format(db_table, date_col,
+                                                                                      start, end, time_zone)
+
+    # Only keep rows past the watermark
+    if since is not None:
+        since = str(since)
+
+        # Naive watermarks are in the given time zone
+        if '+' not in since[10:] and '-' not in since[10:]:
+            since = '{0} {1}'.format(since, time_zone)
+
+        if key_col is None or since_key is None:
+            condition = '"{0}" > \'{1}\''.format(date_col, since)
+        else:
+            condition = '("{0}", "{1}") > (\'{2}\', \'{3}\')'.format(date_col, key_col, since, since_key)
+
+        if ' WHERE ' in command:
+            command = command + ' AND ' + condition
+        else:
+            command = command + ' WHERE ' + condition
+
+    # Server order, so the last row is the watermark under the column's collation
+    if key_col is not None:
+        command = command + ' ORDER BY "{0}", "{1}"'.format(date_col, key_col)
+
+    return command
+
+
+def fetch_chunks(cursor, chunk_size=100000):
+    """
+    :Description:
+    Yield the results of an executed query as DataFrames of chunk_size rows
+
+    :Params:
+    cursor: Cursor with an executed query, ideally named (server-side)
+        type: psycopg2 cursor
+    chunk_size: Number of rows to fetch at a time
+        type: int
+        default: 100000
+
+    :Returns:
+    Generator of pandas DataFrames
+
+    :Dependencies:
+    Python3
+    pandas
+    psycopg2
+
+    :Notes:
+    Column names are read from the cursor description, so no extra query is needed
+
+    :Example:
+    for chunk in fetch_chunks(cursor):
+        print(len(chunk))
+    """
+
+    import pandas as pd
+
+    while True:
+        records = cursor.fetchmany(chunk_size)
+
+        if not records:
+            break
+
+        col_names = [desc[0] for desc in cursor.description]
+
+        with stage('convert'):
+            df = pd.DataFrame.from_records(records, columns=col_names)
+
+        yield df
+
+
+@profiled
+def load_data_iter(db_table=None, start=None, end=None, date_col='date_time', chunk_size=100000,
+                   time_zone='America/New_York', since=None, key_col=None, since_key=None, *args, **kwargs):
+    """
+    :Description:
+    Load data from database one chunk at a time
+
+    :Params:
+    db_table: Database table name
+        type: str
+        default: None
+    start: Start date[time]
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    end: End date[time]
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    date_col: Datetime column
+        type: str
+        default: date_time
+    chunk_size: Number of rows per chunk
+        type: int
+        default: 100000
+    since: Only load rows newer than this date_col value (watermark)
+        type: str/datetime
+        default: None
+    key_col: Tie-break column for rows sharing the watermark
+        type: str
+        default: None
+    since_key: Last seen key_col value at the watermark
+        type: str/int
+        default: None
+
+    :Returns:
+    Generator of pandas DataFrames with date_col already converted to datetime
+
+    :Dependencies:
+    Python3
+    pandas
+    psycopg2
+
+    :Notes:
+    Rows are streamed through a server-side cursor, so memory is bounded by chunk_size
+    If the query returns no rows, a single empty DataFrame with the column names is yielded
+    The connection goes back to the pool once the generator is exhausted or closed
+
+    :Example:
+    totals = {}
+    for chunk in load_data_iter(db_table='some_table', start='2019-01-01', date_col='Date_Time'):
+        for key, grp in chunk.groupby('ID'):
+            totals[key] = totals.get(key, 0) + len(grp)
+    """
+
+    import pandas as pd
+    from generic.db_pool import get_connection
+
+    params = get_params(*args, **kwargs)
+
+    command = build_command(params['schema'], db_table, start, end, date_col, time_zone, since, key_col, since_key)
+
+    # Check out a pooled connection, returned once the generator is exhausted or closed
+    with get_connection(params) as conn:
+        # Named cursors are kept on the server and read with fetchmany
+        cursor = conn.cursor(name='load_data')
+        cursor.itersize = chunk_size
+
+        cursor.execute(command)
+
+        empty = True
+
+        for chunk in fetch_chunks(cursor, chunk_size):
+            empty = False
+
+            # Convert date column to datetime format
+            try:
+                chunk[date_col] = pd.to_datetime(chunk[date_col], infer_datetime_format=True)
+            except:
+                pass
+
+            yield chunk
+
+        if empty:
+            yield pd.DataFrame(columns=[desc[0] for desc in cursor.description or []])
+
+        cursor.close()
+
+
+def split_range(start, end, partition='1D'):
+    """
+    :Description:
+    Split a time frame into consecutive sub-ranges
+
+    :Params:
+    start: Start date[time]
+        type: str
+        format: YYYY-MM-DD [HH:MM:SS]
+    end: End date[time]
+        type: str
+        format: YYYY-MM-DD [HH:MM:SS]
+    partition: Length of each sub-range
+        type: str
+        format: pandas Timedelta string (1D, 6H, 1H, ...)
+        default: 1D
+
+    :Returns:
+    ranges: Start/end pairs covering [start, end) in ascending order
+        type: list
+        format: [(YYYY-MM-DD HH:MM:SS, YYYY-MM-DD HH:MM:SS), ...]
+
+    :Dependencies:
+    Python3
+    pandas
+
+    :Example:
+    split_range('2019-01-01', '2019-01-03')
+    """
+
+    import pandas as pd
+
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    step = pd.Timedelta(partition)
+
+    ranges = []
+    while start < end:
+        stop = min(start + step, end)
+        ranges.append((start.strftime('%Y-%m-%d %H:%M:%S'), stop.strftime('%Y-%m-%d %H:%M:%S')))
+        start = stop
+
+    return ranges
+
+
+@profiled
 def load_data(db_table=None, start=None, end=None, date_col='date_time', chunk_size=100000,
-              time_zone='America/New_York', *args, **kwargs):
+              time_zone='America/New_York', stream=False, workers=None, partition='1D', cache_dir=None,
+              cache_size=2 ** 30, fast=False, *args, **kwargs):
     """
     :Description:
     Load data from database
@@ -40,6 +311,25 @@ def load_data(db_table=None, start=None, end=None, date_col='date_time', chunk_s
     chunk_size: Number of rows to load at a time
         type: int
         default: 100000
+    stream: Stream the rows through a server-side cursor (see load_data_iter) instead of paging with LIMIT/OFFSET
+        type: bool
+        default: False
+    workers: Number of sub-ranges to load at the same time
+        type: int
+        default: None
+    partition: Length of each sub-range when loading in parallel
+        type: str
+        format: pandas Timedelta string (1D, 6H, 1H, ...)
+        default: 1D
+    cache_dir: Folder of the local day cache
+        type: str
+        default: None (no caching)
+    cache_size: Maximum size of the local day cache in bytes
+        type: int
+        default: 1073741824 (1 GB)
+    fast: Fetch the rows with COPY ... TO STDOUT and parse them with pyarrow (see load_data_copy)
+        type: bool
+        default: False
 
     :Returns:
     df: Data from given table for specified time frame
@@ -53,69 +343,97 @@ def load_data(db_table=None, start=None, end=None, date_col='date_time', chunk_s
     If start is not given, all data before end will be loaded
     If end is not given, all data after start will be loaded
     If neither start nor end are given, all data will be loaded
+    With stream=True the query runs once and the rows are pulled chunk_size at a time,
+    so the load is linear in the number of rows and the DataFrame is built once at the end
+    With workers > 1, [start, end) is split into partition-sized sub-ranges that are loaded
+    at the same time on a thread pool, each on its own pooled connection, and concatenated in order
+    With cache_dir set (and start given), closed days are read from a local Parquet cache (see data_cache)
+    and only missing days and today are loaded from the database
+    With fast=True, no Python object is created per cell and the datetime columns come back typed
 
     :Example:
     load_data(db_table='some_table', start='2019-01-01')
+    load_data(db_table='some_table', start='2019-01-01', stream=True)
+    load_data(db_table='some_table', start='2019-01-01', end='2019-02-01', workers=8, partition='1D')
+    load_data(db_table='some_table', start='2019-01-01', fast=True)
     """
 
-    import psycopg2
     import pandas as pd
+    from generic.db_pool import get_connection
+
+    if cache_dir is not None and start is not None:
+        from generic.data_cache import load_cached
+
+        return load_cached(db_table, start, end, date_col, chunk_size, time_zone, cache_dir, cache_size,
+                           *args, **kwargs)
+    if workers is not None and workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        if start is None or end is None:
+            raise Exception('Please provide both start and end to load in parallel')
+
+        def load_range(bounds):
+            # Each sub-range runs on its own pooled connection
+            if fast:
+                return load_data_copy(db_table, bounds[0], bounds[1], date_col, time_zone, *args, **kwargs)
+
+            return pd.concat(load_data_iter(db_table, bounds[0], bounds[1], date_col, chunk_size, time_zone,
+                                            *args, **kwargs), ignore_index=True)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            dfs = list(executor.map(load_range, split_range(start, end, partition)))
+
+        return pd.concat(dfs, ignore_index=True)
+
+    if fast:
+        return load_data_copy(db_table, start, end, date_col, time_zone, *args, **kwargs)
+
+    if stream:
+        chunks = list(load_data_iter(db_table, start, end, date_col, chunk_size, time_zone, *args, **kwargs))
+
+        df = pd.concat(chunks, ignore_index=True)
+
+        del chunks
+
+        return df
 
     params = get_params(*args, **kwargs)
 
-    base_command = '''SELECT * FROM ''' + '{0}."{1}"'.format(params['schema'], db_table)
+    base_command = build_command(params['schema'], db_table, start, end, date_col, time_zone)
 
-    # Create the database query
-    if start is None and end is None:
-        pass
-    elif start is None:
-        base_command = base_command + ' WHERE "{1}" < \'{2} {3}\''.format(db_table, date_col, end, time_zone)
-    elif end is None:
-        base_command = base_command + ' WHERE "{1}" >= \'{2} {3}\''.format(db_table, date_col, start, time_zone)
-    else:
-        base_command = base_command + ' WHERE "{1}" >= \'{2} {4}\' AND "{1}" < \'{3} {4}\''.format(db_table, date_col,
-                                                                                                start, end, time_zone)
-
-    # Assemble the database metadata
-    conn_str = "host='{0}' dbname='{1}' port='{2}' user='{3}' password='{4}'".format(params['host'],
-                                                                                     params['database'],
-                                                                                     params['port'],
-                                                                                     params['username'],
-                                                                                     params['password'])
-
-    # Connect to the database
-    conn = psycopg2.connect(conn_str)
-    cursor = conn.cursor()
-
-    # Grab the first row from the database table
-    # Needed to get the column names
-    cursor.execute(base_command + ' LIMIT 1'.format(db_table))
-    col_names = [desc[0] for desc in cursor.description]
-
-    df = pd.DataFrame()
-
-    # Iterate through the database rows
-    # Needed if the query selection is too large to fit in the RAM
-    n = 0
-    while True:
-        # Add LIMIT and OFFSET to the command
-        command = base_command + " LIMIT " + str(chunk_size) + " OFFSET " + str(n * chunk_size)
+    # Check out a pooled connection
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
 
-        # Execute the command
-        cursor.execute(command)
-        records = cursor.fetchall()
+        # Grab the first row from the database table
+        # Needed to get the column names
+        cursor.execute(base_command + ' LIMIT 1'.format(db_table))
+        col_names = [desc[0] for desc in cursor.description]
 
-        temp = pd.DataFrame(records)
+        df = pd.DataFrame()
 
-        # Breaks when finished
-        try:
-            temp.columns = col_names
-        except ValueError:
-            break
+        # Iterate through the database rows
+        # Needed if the query selection is too large to fit in the RAM
+        n = 0
+        while True:
+            # Add LIMIT and OFFSET to the command
+            command = base_command + " LIMIT " + str(chunk_size) + " OFFSET " + str(n * chunk_size)
+
+            # Execute the command
+            cursor.execute(command)
+            records = cursor.fetchall()
+
+            temp = pd.DataFrame(records)
 
-        df = df.append(temp)
+            # Breaks when finished
+            try:
+                temp.columns = col_names
+            except ValueError:
+                break
 
-        n += 1
+            df = df.append(temp)
+
+            n += 1
 
     del temp
 
@@ -131,6 +449,225 @@ def load_data(db_table=None, start=None, end=None, date_col='date_time', chunk_s
     return df
 
 
+@profiled
+def load_data_copy(db_table=None, start=None, end=None, date_col='date_time', time_zone='America/New_York',
+                   *args, **kwargs):
+    """
+    :Description:
+    Load data from database with COPY ... TO STDOUT, decoded straight into typed columns
+
+    :Params:
+    db_table: Database table name
+        type: str
+        default: None
+    start: Start date[time]
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    end: End date[time]
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    date_col: Datetime column
+        type: str
+        default: date_time
+
+    :Returns:
+    df: Data from given table for specified time frame
+        type: pandas DataFrame
+
+    :Dependencies:
+    Python3
+    pandas
+    psycopg2
+    pyarrow (optional, falls back on pandas.read_csv)
+
+    :Notes:
+    The query result is streamed by the server as CSV into a spooled buffer (in memory up to 256 MB, then on disk)
+    and parsed column by column by pyarrow, so no Python object is created per cell
+    Column types come from the query (LIMIT 0 cursor description), not from the CSV text, so text keys keep
+    their leading zeros and strings like NA stay strings
+    NULLs are written as \\N, so empty strings are kept as empty strings
+    Timestamps with time zone are returned in UTC; numeric columns are read as float64
+
+    :Example:
+    load_data_copy(db_table='some_table', start='2019-01-01', date_col='Date_Time')
+    """
+
+    import tempfile
+    import pandas as pd
+    from generic.db_pool import get_connection
+
+    params = get_params(*args, **kwargs)
+
+    command = build_command(params['schema'], db_table, start, end, date_col, time_zone)
+
+    with tempfile.SpooledTemporaryFile(max_size=2 ** 28) as buffer:
+        # Check out a pooled connection
+        with get_connection(params) as conn:
+            cursor = conn.cursor()
+
+            # Column types of the query
+            cursor.execute(command + ' LIMIT 0')
+            kinds = {desc[0]: pg_types.get(desc[1], 'string') for desc in cursor.description}
+
+            # Timestamps with time zone are written with a +00 offset
+            cursor.execute("SET LOCAL TimeZone TO 'UTC'")
+
+            cursor.copy_expert('COPY ({0}) TO STDOUT WITH (FORMAT csv, HEADER, NULL \'\\N\')'.format(command),
+                               buffer)
+
+            cursor.close()
+
+        buffer.seek(0)
+
+        with stage('convert'):
+            try:
+                import pyarrow as pa
+                from pyarrow import csv
+
+                arrow_types = {'bool': pa.bool_(), 'int16': pa.int16(), 'int32': pa.int32(), 'int64': pa.int64(),
+                               'float32': pa.float32(), 'float64': pa.float64(), 'date': pa.date32(),
+                               'timestamp': pa.timestamp('us'), 'timestamptz': pa.timestamp('us', tz='UTC'),
+                               'string': pa.string()}
+
+                options = csv.ConvertOptions(column_types={i: arrow_types[kinds[i]] for i in kinds},
+                                             null_values=['\\N'], strings_can_be_null=True,
+                                             quoted_strings_can_be_null=False, true_values=['t'],
+                                             false_values=['f'])
+
+                df = csv.read_csv(buffer, convert_options=options).to_pandas()
+            except ImportError:
+                pandas_types = {'bool': 'boolean', 'int16': 'Int16', 'int32': 'Int32', 'int64': 'Int64',
+                                'float32': 'float32', 'float64': 'float64'}
+
+                df = pd.read_csv(buffer, dtype={i: pandas_types.get(kinds[i], str) for i in kinds},
+                                 keep_default_na=False, na_values=['\\N'], true_values=['t'], false_values=['f'])
+
+                for col in kinds:
+                    if kinds[col] not in ('date', 'timestamp', 'timestamptz'):
+                        continue
+
+                    # Fractional seconds are left out when zero, format='ISO8601' needs pandas 2
+                    try:
+                        values = pd.to_datetime(df[col], utc=kinds[col] == 'timestamptz', format='ISO8601')
+                    except (TypeError, ValueError):
+                        values = pd.to_datetime(df[col], utc=kinds[col] == 'timestamptz')
+
+                    df[col] = values.dt.date if kinds[col] == 'date' else values
+
+    # Date columns stored as text
+    if date_col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[date_col]):
+        df[date_col] = pd.to_datetime(df[date_col], utc=True)
+
+    return df
+
+
+@profiled
+def load_new_data(db_table=None, start=None, date_col='date_time', key_col=None, chunk_size=100000,
+                  time_zone='America/New_York', *args, **kwargs):
+    """
+    :Description:
+    Load only the rows added since the last call and merge them into a per-table buffer
+
+    :Params:
+    db_table: Database table name
+        type: str
+        default: None
+    start: Start date[time] of the buffer
+        type: str
+        default: None
+        format: YYYY-MM-DD [HH:MM:SS]
+    date_col: Datetime column (watermark)
+        type: str
+        default: date_time
+    key_col: Tie-break column for rows sharing the watermark
+        type: str
+        default: None
+    chunk_size: Number of rows to load at a time
+        type: int
+        default: 100000
+
+    :Returns:
+    df: All buffered data for the table since start
+        type: pandas DataFrame
+
+    :Dependencies:
+    Python3
+    pandas
+    psycopg2
+
+    :Notes:
+    The first call (or a call with a different start) loads everything after start
+    Later calls only load rows past the largest (date_col, key_col) already in the buffer,
+    so the cost of each poll depends on the number of new rows
+    With key_col, rows are loaded ordered by (date_col, key_col) and the watermark is the last row the server
+    sent, so text keys are compared with the column's collation rather than the pandas sort order
+    Rows must be inserted in (date_col, key_col) order for the watermark to catch every row
+    Use reset_buffer to clear the buffer of a table
+
+    :Example:
+    df = load_new_data('waze_api', '2019-01-01', date_col='Date_Time', key_col='ID')
+    """
+
+    import pandas as pd
+
+    buffer = buffers.get(db_table)
+
+    # Start over when the buffer is missing or covers a different time frame
+    if buffer is None or buffer['start'] != start or buffer['df'].empty:
+        df = pd.concat(load_data_iter(db_table, start, None, date_col, chunk_size, time_zone, None, key_col, None,
+                                      *args, **kwargs), ignore_index=True)
+        new = df
+        since, since_key = None, None
+    else:
+        df = buffer['df']
+        since, since_key = buffer['since'], buffer['since_key']
+
+        new = pd.concat(load_data_iter(db_table, start, None, date_col, chunk_size, time_zone, since, key_col,
+                                       since_key, *args, **kwargs), ignore_index=True)
+
+        if not new.empty:
+            df = pd.concat([df, new], ignore_index=True, sort=False)
+
+    # Last seen row
+    if not new.empty:
+        if key_col is None:
+            since = new[date_col].max()
+        else:
+            since, since_key = new[date_col].iloc[-1], new[key_col].iloc[-1]
+
+    buffers[db_table] = {'start': start, 'df': df, 'since': since, 'since_key': since_key}
+
+    return df.copy()
+
+
+def reset_buffer(db_table=None):
+    """
+    :Description:
+    Clear the buffer used by load_new_data
+
+    :Params:
+    db_table: Database table name
+        type: str
+        default: None (all tables)
+
+    :Returns:
+    Nothing, clears the buffer
+
+    :Dependencies:
+    Python3
+
+    :Example:
+    reset_buffer('waze_api')
+    """
+
+    if db_table is None:
+        buffers.clear()
+    else:
+        buffers.pop(db_table, None)
+
+
 if __name__ == '__main__':
 
     print(__doc__)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+"""
+#########################
+Spatial Index
+#########################
+
+:Description:
+    Grid index over projected (Web Mercator) shapes for batch nearest-segment and point-in-polygon lookups
+
+:Usage:
+    Called from other scripts
+
+:Notes:
+    Built from the x/y columns of load_shape (get_coord_buffers/project_geometries output) or from a GeoSeries
+    Query points must be in the same projection, e.g. x, y = to_mercator(lon, lat)
+    Distances are in projected units; Web Mercator stretches them by 1 / cos(latitude) (about 1.32 in NYC)
+
+"""
+
+import numpy as np
+
+from generic.geospatial import ragged_to_flat, get_coord_buffers, to_mercator
+
+
+class SpatialIndex(object):
+    """
+    :Description:
+    Uniform grid over the segments (edges) of a set of shapes
+
+    :Params:
+    xs: x coordinates, one entry per shape, parts separated with np.nan
+        type: sequence of arrays/floats
+    ys: y coordinates, one entry per shape, parts separated with np.nan
+        type: sequence of arrays/floats
+    cell_size: Grid cell width and height
+        type: float
+        default: None (median segment extent)
+    max_cells: Maximum number of grid cells
+        type: int
+        default: 4194304
+    closed: Which shapes are polygons, one per shape
+        type: sequence of bool
+        default: None (shapes whose parts all end on their first vertex)
+
+    :Dependencies:
+    Python3
+    numpy
+
+    :Notes:
+    Each segment is registered in every cell its bounding box touches; the cells are stored as one sorted
+    array with a start offset per cell, so looking up a cell is two array reads
+    The cell size is grown if needed so the grid has at most max_cells cells
+    Nearest queries are usually fastest with a cell_size close to the query radius
+    Polygon shapes must be closed rings (as shapely returns them); holes and multi-parts use the even-odd rule
+    Only closed shapes can contain points, lines are skipped by contains
+
+    :Example:
+    gdf = load_shape('waze_routes.txt')
+    index = SpatialIndex(gdf['x'], gdf['y'])
+    shape, segment, dist = index.nearest(*to_mercator(lon, lat), k=3, radius=200)
+    """
+
+    def __init__(self, xs, ys, cell_size=None, max_cells=2 ** 22, closed=None):
+        x, offsets = ragged_to_flat(xs)
+        y, _ = ragged_to_flat(ys)
+
+        # Shape of every vertex
+        vertex_shape = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+        # Segments join consecutive finite vertices of the same shape
+        valid = np.isfinite(x[:-1]) & np.isfinite(x[1:]) & np.isfinite(y[:-1]) & np.isfinite(y[1:]) & \
+            (vertex_shape[:-1] == vertex_shape[1:])
+        start = np.flatnonzero(valid)
+
+        self.n_shapes = len(offsets) - 1
+        self.x0, self.y0 = x[start], y[start]
+        self.x1, self.y1 = x[start + 1], y[start + 1]
+        self.segment_shape = vertex_shape[start]
+
+        # Bounding box of every shape and whether it is made of closed rings
+        self.bounds = np.full((self.n_shapes, 4), np.nan)
+        self.closed = np.zeros(self.n_shapes, dtype=bool)
+        for i in range(self.n_shapes):
+            sx, sy = x[offsets[i]:offsets[i + 1]], y[offsets[i]:offsets[i + 1]]
+            if np.isfinite(sx).any():
+                self.bounds[i] = np.nanmin(sx), np.nanmin(sy), np.nanmax(sx), np.nanmax(sy)
+
+                # Parts are separated with NaN
+                breaks = np.flatnonzero(np.isnan(sx))
+                firsts = np.concatenate([[0], breaks + 1])
+                lasts = np.concatenate([breaks, [len(sx)]]) - 1
+                self.closed[i] = ((lasts - firsts >= 3) & (sx[firsts] == sx[lasts]) & (sy[firsts] == sy[lasts])).all()
+
+        if closed is not None:
+            self.closed = np.asarray(closed, dtype=bool)
+
+        if cell_size is None:
+            extent = np.maximum(np.abs(self.x1 - self.x0), np.abs(self.y1 - self.y0))
+            cell_size = float(np.median(extent)) if len(extent) else 1.0
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+
+        self.build(max_cells)
+
+    @classmethod
+    def from_geometries(cls, geometries, project=True, interiors=True, cell_size=None, max_cells=2 ** 22):
+        """
+        :Description:
+        Build the index straight from a GeoSeries
+
+        :Params:
+        geometries: Geometries
+            type: geopandas GeoSeries/sequence of shapely geometries
+        project: Project longitude/latitude (EPSG:4326) to Web Mercator first
+            type: bool
+            default: True
+        interiors: Include polygon holes
+            type: bool
+            default: True
+        cell_size: Grid cell width and height
+            type: float
+            default: None
+        max_cells: Maximum number of grid cells
+            type: int
+            default: 4194304
+
+        :Returns:
+        Spatial index
+            type: SpatialIndex
+        """
+
+        geometries = list(geometries)
+
+        _, _, _, _, xs, ys = get_coord_buffers(geometries, interiors=interiors,
+                                               transform=to_mercator if project else None)
+
+        closed = [i is not None and i.geom_type in ('Polygon', 'MultiPolygon') for i in geometries]
+
+        return cls(xs, ys, cell_size, max_cells, closed)
+
+    def cells(self, x, y):
+        # Grid column/row of coordinates
+        return np.floor((x - self.origin[0]) / self.cell_size).astype(np.int64), \
+            np.floor((y - self.origin[1]) / self.cell_size).astype(np.int64)
+
+    def build(self, max_cells):
+        if len(self.x0):
+            self.origin = (min(self.x0.min(), self.x1.min()), min(self.y0.min(), self.y1.min()))
+            width = max(self.x0.max(), self.x1.max()) - self.origin[0]
+            height = max(self.y0.max(), self.y1.max()) - self.origin[1]
+        else:
+            self.origin, width, height = (0.0, 0.0), 0.0, 0.0
+
+        # Keep the grid within max_cells
+        while (width // self.cell_size + 1) * (height // self.cell_size + 1) > max_cells:
+            self.cell_size *= 2
+
+        self.n_cols, self.n_rows = int(width // self.cell_size) + 1, int(height // self.cell_size) + 1
+
+        ix0, iy0 = self.cells(np.minimum(self.x0, self.x1), np.minimum(self.y0, self.y1))
+        ix1, iy1 = self.cells(np.maximum(self.x0, self.x1), np.maximum(self.y0, self.y1))
+
+        # Register every segment in every cell of its bounding box
+        height = iy1 - iy0 + 1
+        counts = (ix1 - ix0 + 1) * height
+
+        segment = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        keys = (ix0[segment] + local // height[segment]) * self.n_rows + iy0[segment] + local % height[segment]
+
+        order = np.argsort(keys, kind='stable')
+        self.cell_segments = segment[order]
+
+        # Segments of cell i are cell_segments[cell_starts[i]:cell_starts[i + 1]]
+        self.cell_starts = np.zeros(self.n_cols * self.n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=self.n_cols * self.n_rows), out=self.cell_starts[1:])
+
+    def candidates(self, px, py, reach):
+        # Yield the (point, segment) pairs of each cell offset within reach cells of the points
+        ix, iy = self.cells(px, py)
+
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                # Skip corner cells that are entirely out of reach
+                if (max(abs(dx), 1) - 1) ** 2 + (max(abs(dy), 1) - 1) ** 2 > reach ** 2:
+                    continue
+
+                cx, cy = ix + dx, iy + dy
+
+                point = np.flatnonzero((cx >= 0) & (cx < self.n_cols) & (cy >= 0) & (cy < self.n_rows))
+                keys = cx[point] * self.n_rows + cy[point]
+
+                start = self.cell_starts[keys]
+                counts = self.cell_starts[keys + 1] - start
+
+                local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+                yield np.repeat(point, counts), self.cell_segments[np.repeat(start, counts) + local]
+
+    def distance(self, px, py, segment):
+        # Distance from points to segments (elementwise)
+        x0, y0 = self.x0[segment], self.y0[segment]
+        dx, dy = self.x1[segment] - x0, self.y1[segment] - y0
+
+        length = dx ** 2 + dy ** 2
+        t = np.divide((px - x0) * dx + (py - y0) * dy, length, out=np.zeros_like(length), where=length > 0)
+        t = np.clip(t, 0, 1)
+
+        return np.hypot(px - (x0 + t * dx), py - (y0 + t * dy))
+
+    def nearest(self, px, py, k=1, radius=None, chunk_size=100000):
+        """
+        :Description:
+        k nearest segments of each point, within a radius
+
+        :Params:
+        px: x coordinates of the points
+            type: array-like
+        py: y coordinates of the points
+            type: array-like
+        k: Number of segments per point
+            type: int
+            default: 1
+        radius: Search radius (projected units)
+            type: float
+            default: None (cell_size)
+        chunk_size: Number of points queried at a time
+            type: int
+            default: 100000
+
+        :Returns:
+        shape: Shape of each match (-1 if none)
+            type: numpy array (N x k)
+        segment: Segment of each match (-1 if none), see segment_shape/x0/y0/x1/y1
+            type: numpy array (N x k)
+        dist: Distance to each match (np.nan if none), closest first
+            type: numpy array (N x k)
+        """
+
+        px, py = np.asarray(px, dtype=float).ravel(), np.asarray(py, dtype=float).ravel()
+
+        if radius is None:
+            radius = self.cell_size
+
+        segment = np.full((len(px), k), -1, dtype=np.int64)
+        dist = np.full((len(px), k), np.nan)
+
+        if not len(self.x0):
+            return segment.copy(), segment, dist
+
+        reach = int(np.ceil(radius / self.cell_size))
+
+        for offset in range(0, len(px), chunk_size):
+            cx, cy = px[offset:offset + chunk_size], py[offset:offset + chunk_size]
+
+            points, candidates, dists = [], [], []
+            for point, candidate in self.candidates(cx, cy, reach):
+                d = self.distance(cx[point], cy[point], candidate)
+
+                keep = d <= radius
+                points.append(point[keep])
+                candidates.append(candidate[keep])
+                dists.append(d[keep])
+
+            point, candidate, d = np.concatenate(points), np.concatenate(candidates), np.concatenate(dists)
+
+            # Closest first; a segment reached through several cells shows up next to itself
+            order = np.lexsort((candidate, d, point))
+            point, candidate, d = point[order], candidate[order], d[order]
+
+            unique = np.ones(len(point), dtype=bool)
+            unique[1:] = (point[1:] != point[:-1]) | (candidate[1:] != candidate[:-1])
+            point, candidate, d = point[unique], candidate[unique], d[unique]
+
+            rank = np.arange(len(point)) - np.searchsorted(point, point)
+            keep = rank < k
+
+            segment[offset + point[keep], rank[keep]] = candidate[keep]
+            dist[offset + point[keep], rank[keep]] = d[keep]
+
+        shape = np.where(segment >= 0, self.segment_shape[segment], -1)
+
+        return shape, segment, dist
+
+    def contains(self, px, py, chunk_size=4000000):
+        """
+        :Description:
+        Shape (polygon) containing each point
+
+        :Params:
+        px: x coordinates of the points
+            type: array-like
+        py: y coordinates of the points
+            type: array-like
+        chunk_size: Maximum number of point/edge pairs tested at a time
+            type: int
+            default: 4000000
+
+        :Returns:
+        Polygon containing each point (lowest index if several, -1 if none), lines never contain points
+            type: numpy array
+
+        :Notes:
+        Points are sorted by x once, so each shape only tests the points inside its bounding box
+        """
+
+        px, py = np.asarray(px, dtype=float).ravel(), np.asarray(py, dtype=float).ravel()
+
+        result = np.full(len(px), -1, dtype=np.int64)
+
+        order = np.argsort(px, kind='stable')
+        sorted_x = px[order]
+
+        edge_order = np.argsort(self.segment_shape, kind='stable')
+        edge_starts = np.searchsorted(self.segment_shape[edge_order], np.arange(self.n_shapes + 1))
+
+        for shape in range(self.n_shapes):
+            min_x, min_y, max_x, max_y = self.bounds[shape]
+            edges = edge_order[edge_starts[shape]:edge_starts[shape + 1]]
+
+            if not self.closed[shape] or np.isnan(min_x) or not len(edges):
+                continue
+
+            candidate = order[np.searchsorted(sorted_x, min_x):np.searchsorted(sorted_x, max_x, side='right')]
+            candidate = candidate[(py[candidate] >= min_y) & (py[candidate] <= max_y) & (result[candidate] < 0)]
+
+            x0, y0, x1, y1 = self.x0[edges], self.y0[edges], self.x1[edges], self.y1[edges]
+
+            step = max(1, chunk_size // len(edges))
+            for offset in range(0, len(candidate), step):
+                point = candidate[offset:offset + step]
+                cx, cy = px[point][:, None], py[point][:, None]
+
+                # Even-odd rule: count the edges crossed by a ray going right from the point
+                straddle = (y0 > cy) != (y1 > cy)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    cross_x = x0 + (cy - y0) * (x1 - x0) / (y1 - y0)
+                inside = (straddle & (cx < cross_x)).sum(axis=1) % 2 == 1
+
+                result[point[inside]] = shape
+
+        return result
+
+
+if __name__ == '__main__':
+    print(__doc__)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+#########################
+Status Reporter
+#########################
+
+:Description:
+    Sends script statuses to the internal status dashboard from a background thread
+
+:Usage:
+    Called from other scripts
+
+:Notes:
+    Statuses are queued in memory and repeated updates for the same script/location are coalesced
+    The queue is flushed every interval seconds and at exit with update_internal_status_db_batch
+    Database errors are printed and the statuses are kept for the next flush, so the calling script never waits or fails
+
+"""
+
+import atexit
+import threading
+import traceback
+from datetime import datetime
+
+# Default reporter used by report_status
+reporter = None
+
+
+class StatusReporter(object):
+    """
+    :Description:
+    Background reporter for the internal status dashboard
+
+    :Params:
+    interval: Seconds between flushes
+        type: float
+        default: 30
+    db_table: Name of the database table
+        type: str
+        default: internal_status_dashboard
+    timeout: Seconds to wait for the last flush at exit
+        type: float
+        default: 10
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Example:
+    status = StatusReporter(interval=60)
+    status.report('automation/waze/some_script', 'VM1', False, '')
+    """
+
+    def __init__(self, interval=30, db_table='internal_status_dashboard', timeout=10, *args, **kwargs):
+        self.interval = interval
+        self.db_table = db_table
+        self.timeout = timeout
+        self.args = args
+        self.kwargs = kwargs
+
+        # Latest status of each script/location
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.run, name='status_reporter', daemon=True)
+        self.thread.start()
+
+        atexit.register(self.stop)
+
+    def report(self, script, location, flag, description, date=None):
+        """
+        :Description:
+        Queue the status of a script, replacing any queued status for the same script/location
+
+        :Params:
+        script: Name of the script
+            type: str
+        location: Location of the script
+            type: str
+        flag: Did the script trip a flag?
+            type: bool
+        description: Description of the flag
+            type: str
+        date: Date/time that the script was run
+            type: str/datetime
+            default: None (current UTC time)
+
+        :Returns:
+        Nothing, queues the status
+        """
+
+        # Keep the time of the event, not of the flush
+        if date is None:
+            date = datetime.utcnow().replace(microsecond=0)
+
+        with self.lock:
+            self.pending[(script, location)] = {'script': script, 'location': location, 'flag': flag,
+                                                'description': description, 'date': date}
+
+    def flush(self):
+        """
+        :Description:
+        Send the queued statuses to the database
+
+        :Returns:
+        Nothing, updates the internal status dashboard database table
+        """
+
+        from generic.update_internal_status_db import update_internal_status_db_batch
+
+        with self.lock:
+            statuses, self.pending = self.pending, {}
+
+        if not statuses:
+            return
+
+        try:
+            update_internal_status_db_batch(list(statuses.values()), self.db_table, *self.args, **self.kwargs)
+        except Exception:
+            print(traceback.format_exc())
+
+            # Requeue, without overwriting newer statuses
+            with self.lock:
+                for key in statuses:
+                    self.pending.setdefault(key, statuses[key])
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+            self.flush()
+
+            if self.stopped.is_set():
+                break
+
+    def stop(self):
+        """
+        :Description:
+        Flush the queued statuses and stop the background thread
+
+        :Returns:
+        Nothing
+        """
+
+        if self.stopped.is_set():
+            return
+
+        self.stopped.set()
+        self.wake.set()
+
+        # Don't hold up the exit if the database is unreachable
+        self.thread.join(self.timeout)
+
+
+def report_status(script, location, flag, description, date=None, interval=30, db_table='internal_status_dashboard',
+                  *args, **kwargs):
+    """
+    :Description:
+    Queue the status of a script on the default background reporter
+
+    :Params:
+    script: Name of the script
+        type: str
+    location: Location of the script
+        type: str
+    flag: Did the script trip a flag?
+        type: bool
+    description: Description of the flag
+        type: str
+    date: Date/time that the script was run
+        type: str
+        default: None
+    interval: Seconds between flushes (only used when the reporter is created)
+        type: float
+        default: 30
+    db_table: Name of the database table (only used when the reporter is created)
+        type: str
+        default: internal_status_dashboard
+    returns: Nothing, queues the status
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Example:
+    report_status('automation/waze/some_script', 'VM1', True, 'Something went wrong...script failed')
+    """
+
+    global reporter
+
+    if reporter is None:
+        reporter = StatusReporter(interval, db_table, 10, *args, **kwargs)
+
+    reporter.report(script, location, flag, description, date)
+
+
+if __name__ == '__main__':
+
+    print(__doc__)
@@ -13,6 +13,8 @@ To DB
 
 """
 
+from generic.db_profiler import profiled
+
 
 def check_if_table_exists(cursor, schema, db_table):
     command = '''SELECT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = ''' + \
@@ -23,70 +25,289 @@ def check_if_table_exists(cursor, schema, db_table):
     return cursor.fetchone()[0]
 
 
-def create_table(df, db_table, params, d_types):
-    import sqlalchemy
+# Postgres types of the datatype names accepted in d_types
+# Names that aren't listed (timestamptz, varchar(20), ...) are used as they are
+type_names = {'bigint': 'BIGINT',
+              'binary': 'BYTEA',
+              'bool': 'BOOLEAN',
+              'boolean': 'BOOLEAN',
+              'char': 'CHAR',
+              'clob': 'TEXT',
+              'date': 'DATE',
+              'datetime': 'TIMESTAMP',
+              'decimal': 'NUMERIC',
+              'float': 'DOUBLE PRECISION',
+              'integer': 'INTEGER',
+              'int': 'INTEGER',
+              'json': 'JSON',
+              'nchar': 'CHAR',
+              'numeric': 'NUMERIC',
+              'nvarchar': 'VARCHAR',
+              'real': 'REAL',
+              'smallint': 'SMALLINT',
+              'text': 'TEXT',
+              'time': 'TIME',
+              'timestamp': 'TIMESTAMP',
+              'varbinary': 'BYTEA',
+              'varchar': 'VARCHAR'}
+
+# Postgres types of pandas dtypes, by dtype name
+dtype_names = {'bool': 'BOOLEAN',
+               'boolean': 'BOOLEAN',
+               'int8': 'SMALLINT',
+               'int16': 'SMALLINT',
+               'int32': 'INTEGER',
+               'int64': 'BIGINT',
+               'Int8': 'SMALLINT',
+               'Int16': 'SMALLINT',
+               'Int32': 'INTEGER',
+               'Int64': 'BIGINT',
+               'uint8': 'SMALLINT',
+               'uint16': 'INTEGER',
+               'uint32': 'BIGINT',
+               'uint64': 'NUMERIC(20)',
+               'UInt8': 'SMALLINT',
+               'UInt16': 'INTEGER',
+               'UInt32': 'BIGINT',
+               'UInt64': 'NUMERIC(20)',
+               'float16': 'REAL',
+               'float32': 'REAL',
+               'float64': 'DOUBLE PRECISION',
+               'Float32': 'REAL',
+               'Float64': 'DOUBLE PRECISION',
+               'string': 'TEXT',
+               'object': 'TEXT'}
+
+# Postgres types of pandas dtypes, by dtype kind (used when the name isn't listed)
+dtype_kinds = {'b': 'BOOLEAN',
+               'i': 'BIGINT',
+               'u': 'BIGINT',
+               'f': 'DOUBLE PRECISION',
+               'c': 'TEXT',
+               'M': 'TIMESTAMP',
+               'm': 'INTERVAL',
+               'O': 'TEXT',
+               'S': 'BYTEA',
+               'U': 'TEXT'}
+
+
+def infer_type(dtype):
+    """
+    :Description:
+    Postgres type of a pandas dtype
+
+    :Params:
+    dtype: Column datatype
+        type: numpy/pandas dtype
+
+    :Returns:
+    Postgres type
+        type: str
+
+    :Dependencies:
+    Python3
+    pandas
+
+    :Notes:
+    Time zone aware timestamps are TIMESTAMPTZ, categoricals get the type of their categories
+
+    :Example:
+    infer_type(df['Date_Time'].dtype)
+    """
 
-    engine = sqlalchemy.create_engine('postgresql+psycopg2://{0}:{1}@{2}/{3}'.format(params['username'],
-                                                                                     params['password'],
-                                                                                     params['host'],
-                                                                                     params['database']))
+    # Categoricals are stored as their values
+    categories = getattr(dtype, 'categories', None)
+    if categories is not None:
+        return infer_type(categories.dtype)
+
+    if getattr(dtype, 'kind', None) == 'M' and getattr(dtype, 'tz', None) is not None:
+        return 'TIMESTAMPTZ'
+
+    if str(dtype) in dtype_names:
+        return dtype_names[str(dtype)]
+
+    return dtype_kinds.get(getattr(dtype, 'kind', 'O'), 'TEXT')
+
+
+def infer_schema(df, d_types=None):
+    """
+    :Description:
+    Postgres type of every column of a DataFrame
+
+    :Params:
+    df: Data
+        type: pandas DataFrame
+    d_types: The datatypes of some columns, overriding the inferred ones
+        type: dict
+        default: None
+
+    :Returns:
+    schema: Postgres type of each column
+        type: dict
+        format: {column_name_0: type_0, column_name_1: type_1, ...}
+
+    :Dependencies:
+    Python3
+    pandas
+
+    :Example:
+    infer_schema(df, {'ID': 'text'})
+    """
+
+    schema = {c: infer_type(df[c].dtype) for c in df.columns}
 
-    # Convert data types from string to SQLAlchemy format
     if d_types is not None:
-        for i in d_types:
-            if d_types[i].lower() == 'bigint':
-                d_types[i] = sqlalchemy.BIGINT
-            elif d_types[i].lower() == 'binary':
-                d_types[i] = sqlalchemy.BINARY
-            elif d_types[i].lower() == 'bool':
-                d_types[i] = sqlalchemy.BOOLEAN
-            elif d_types[i].lower() == 'boolean':
-                d_types[i] = sqlalchemy.BOOLEAN
-            elif d_types[i].lower() == 'char':
-                d_types[i] = sqlalchemy.CHAR
-            elif d_types[i].lower() == 'clob':
-                d_types[i] = sqlalchemy.CLOB
-            elif d_types[i].lower() == 'date':
-                d_types[i] = sqlalchemy.DATE
-            elif d_types[i].lower() == 'datetime':
-                d_types[i] = sqlalchemy.DATETIME
-            elif d_types[i].lower() == 'decimal':
-                d_types[i] = sqlalchemy.DECIMAL
-            elif d_types[i].lower() == 'float':
-                d_types[i] = sqlalchemy.FLOAT
-            elif d_types[i].lower() == 'integer':
-                d_types[i] = sqlalchemy.INTEGER
-            elif d_types[i].lower() == 'int':
-                d_types[i] = sqlalchemy.INTEGER
-            elif d_types[i].lower() == 'json':
-                d_types[i] = sqlalchemy.JSON
-            elif d_types[i].lower() == 'nchar':
-                d_types[i] = sqlalchemy.NCHAR
-            elif d_types[i].lower() == 'numeric':
-                d_types[i] = sqlalchemy.NUMERIC
-            elif d_types[i].lower() == 'nvarchar':
-                d_types[i] = sqlalchemy.NVARCHAR
-            elif d_types[i].lower() == 'real':
-                d_types[i] = sqlalchemy.REAL
-            elif d_types[i].lower() == 'smallint':
-                d_types[i] = sqlalchemy.SMALLINT
-            elif d_types[i].lower() == 'text':
-                d_types[i] = sqlalchemy.TEXT
-            elif d_types[i].lower() == 'time':
-                d_types[i] = sqlalchemy.TIME
-            elif d_types[i].lower() == 'timestamp':
-                d_types[i] = sqlalchemy.TIMESTAMP
-            elif d_types[i].lower() == 'text':
-                d_types[i] = sqlalchemy.TEXT
-            elif d_types[i].lower() == 'varbinary':
-                d_types[i] = sqlalchemy.VARBINARY
-            elif d_types[i].lower() == 'varchar':
-                d_types[i] = sqlalchemy.VARCHAR
-
-    df.to_sql(db_table, engine, dtype=d_types, schema=params['schema'])
-
-
-def to_db_new(df, db_table, d_types=None, index=False, chunk_size=None, *args, **kwargs):
+        for c in d_types:
+            schema[c] = type_names.get(str(d_types[c]).lower(), d_types[c])
+
+    return schema
+
+
+def create_table(df, db_table, params, d_types, cursor=None, key_cols=None, date_col=None):
+    """
+    :Description:
+    Creates a database table for the columns of a DataFrame
+
+    :Params:
+    df: Data (only the columns and datatypes are used)
+        type: pandas DataFrame
+    db_table: The name of the database table
+        type: str
+    params: Database parameters
+        type: dict
+    d_types: The datatypes of some columns, overriding the inferred ones
+        type: dict
+    cursor: Open database cursor (a pooled connection is used if not given)
+        type: psycopg2 cursor
+        default: None
+    key_cols: Lookup columns to index
+        type: list
+        default: None
+    date_col: Datetime column to index
+        type: str
+        default: None
+    returns: Nothing, creates the database table
+
+    :Dependencies:
+    Python3
+    pandas
+    psycopg2
+
+    :Example:
+    create_table(df.head(0), 'Waze', get_params(), {'ID': 'text'}, key_cols=['ID'], date_col='Date_Time')
+    """
+
+    schema = infer_schema(df, d_types)
+
+    columns = ', '.join(['"{0}" {1}'.format(c, schema[c]) for c in schema])
+
+    commands = ['''CREATE TABLE IF NOT EXISTS ''' + '{0}."{1}" ({2})'.format(params['schema'], db_table, columns)]
+
+    if key_cols is not None:
+        if type(key_cols) != list:
+            key_cols = [key_cols]
+
+        commands.append('''CREATE INDEX IF NOT EXISTS ''' +
+                        '"{0}_{1}_idx" ON {2}."{0}" ({3})'.format(db_table, '_'.join(key_cols), params['schema'],
+                                                                  ', '.join(['"{0}"'.format(i) for i in key_cols])))
+
+    if date_col is not None:
+        commands.append('''CREATE INDEX IF NOT EXISTS ''' +
+                        '"{0}_{1}_idx" ON {2}."{0}" ("{1}")'.format(db_table, date_col, params['schema']))
+
+    if cursor is not None:
+        for command in commands:
+            cursor.execute(command)
+    else:
+        from generic.db_pool import get_connection
+
+        # Check out a pooled connection, committed when the block finishes
+        with get_connection(params) as conn:
+            cursor = conn.cursor()
+
+            for command in commands:
+                cursor.execute(command)
+
+
+def copy_to_table(cursor, df, schema, db_table, chunk_size=100000):
+    """
+    :Description:
+    Streams data into a database table with COPY FROM STDIN
+    Each chunk is written to an in-memory CSV buffer, so memory stays bounded by chunk_size
+
+    :Params:
+    cursor: Open database cursor
+        type: psycopg2 cursor
+    df: Data
+        type: pandas DataFrame
+    schema: Database schema
+        type: str
+    db_table: The name of the database table
+        type: str
+    chunk_size: Number of rows to send at a time
+        type: int
+        default: 100000
+    returns: Number of rows sent
+        type: int
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    Float columns holding only whole numbers (integers with NaN) are written without the .0, so they load
+    into INTEGER/BIGINT columns like they do with INSERT
+    NULLs are written as \\N, so empty strings stay empty strings
+
+    :Example:
+    copy_to_table(cursor, df, 'public', 'Waze')
+    """
+
+    import io
+    from time import time
+    from pandas.api.types import is_float_dtype
+
+    # Integers with NaN are floats in pandas; COPY rejects 1.0 for integer columns
+    ints = {}
+    for col in df.columns:
+        if is_float_dtype(df[col]):
+            values = df[col].dropna()
+            if not values.empty and (values % 1 == 0).all() and (values.abs() < 2 ** 53).all():
+                ints[col] = 'Int64'
+    if ints:
+        df = df.astype(ints)
+
+    cols = ', '.join(['"{0}"'.format(i) for i in df.columns])
+
+    command = '''COPY ''' + '{0}."{1}" ({2}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')'.format(schema, db_table,
+                                                                                                cols)
+
+    n = 0
+    L = len(df)
+    t0 = time()
+
+    while n < L:
+        # Write the chunk to an in-memory CSV buffer
+        buffer = io.StringIO()
+        df.iloc[n: n + chunk_size].to_csv(buffer, index=False, header=False, na_rep='\\N')
+        buffer.seek(0)
+
+        # Stream the buffer to the database
+        cursor.copy_expert(command, buffer)
+
+        n += chunk_size
+
+    elapsed = time() - t0
+
+    print('{0} rows copied to {1}."{2}" in {3:.2f}s ({4:.0f} rows/s)'.format(L, schema, db_table, elapsed,
+                                                                            L / elapsed if elapsed else 0))
+
+    return L
+
+
+@profiled
+def to_db_new(df, db_table, d_types=None, index=False, chunk_size=None, method='insert', conflict_cols=None,
+              on_conflict='update', key_cols=None, date_col=None, *args, **kwargs):
     """
     :Description:
     Pushes data to the selected database table
@@ -105,23 +326,57 @@ def to_db_new(df, db_table, d_types=None, index=False, chunk_size=None, *args, *
     chunk_size: Number of rows to send at a time
         type: int
         default: None
+    method: How to send the data
+        type: str
+        options: insert - multi-row INSERT statements
+                 copy - COPY FROM STDIN, streamed chunk by chunk
+        default: insert
+    conflict_cols: Columns that identify a row; if given, existing rows are merged instead of duplicated
+        type: list
+        default: None
+    on_conflict: What to do with rows that already exist (only used with conflict_cols)
+        type: str
+        options: update - overwrite the other columns
+                 ignore - keep the existing row
+        default: update
+    key_cols: Lookup columns to index when the table is created
+        type: list
+        default: None
+    date_col: Datetime column to index when the table is created
+        type: str
+        default: None
     returns: Nothing, pushes data to database table
 
     :Dependencies:
     Python3
-    sqlalchemy
+    psycopg2
+
+    :Notes:
+    With method='copy', chunk_size defaults to 100000 rows to keep memory bounded
+    Missing tables are created with column types inferred from the DataFrame (see infer_schema)
+    With conflict_cols, the data is bulk copied to a staging table and merged with INSERT ... ON CONFLICT
+    (see upsert_to_db), so no separate drop_duplicates_from_db pass is needed
 
     :Example:
     to_db_new(df, 'Waze')
+    to_db_new(df, 'Waze', method='copy', chunk_size=50000)
+    to_db_new(df, 'Waze', conflict_cols=['ID', 'Date_Time'], on_conflict='update')
     """
 
-    import psycopg2
     import traceback
     from pandas.api.types import is_numeric_dtype
     from generic.get_params import get_params
+    from generic.db_pool import get_connection
 
     params = get_params(*args, **kwargs)
 
+    if conflict_cols is not None:
+        return upsert_to_db(df, db_table, params, conflict_cols, on_conflict, d_types, index, chunk_size, key_cols,
+                            date_col)
+
+    if method == 'copy':
+        return copy_to_db(df, db_table, params, d_types, index, chunk_size, key_cols, date_col)
+
     dd = df.copy()
 
     if index:
@@ -138,55 +393,233 @@ def to_db_new(df, db_table, d_types=None, index=False, chunk_size=None, *args, *
 
     dd = dd.to_numpy()
 
-    # Assemble the database metadata
-    conn_str = "host='{0}' dbname='{1}' port='{2}' user='{3}' password='{4}'".format(params['host'],
-                                                                                     params['database'],
-                                                                                     params['port'],
-                                                                                     params['username'],
-                                                                                     params['password'])
+    try:
+        # Check out a pooled connection, committed when the block finishes
+        with get_connection(params) as conn:
+            # Create new cursor
+            cursor = conn.cursor()
+
+            n = 0
+            L = len(dd)
+            cols = ', '.join(['"{0}"'.format(i) for i in cols])
+
+            if chunk_size is None:
+                chunk_size = L
+
+            exists = check_if_table_exists(cursor, params['schema'], db_table)
+
+            if not exists:
+                create_table(df.head(0), db_table, params, d_types, cursor, key_cols, date_col)
+
+            command = '''INSERT INTO ''' + '{0}."{1}" ({2}) VALUES ('.format(params['schema'], db_table, cols)
+
+            while n < L:
+                # Chunk data and convert to string
+                data = "), (".join([", ".join(i) for i in dd[n: n + chunk_size]]) + ')'
+
+                # Execute command
+                cursor.execute(command + data)
+
+                n += chunk_size
+
+            cursor.close()
+
+    except:
+        print(traceback.format_exc())
+
+
+def copy_to_db(df, db_table, params, d_types=None, index=False, chunk_size=None, key_cols=None, date_col=None):
+    """
+    :Description:
+    Pushes data to the selected database table using COPY FROM STDIN
+
+    :Params:
+    df: Data
+        type: pandas DataFrame
+    db_table: The name of the database table
+        type: str
+    params: Database parameters
+        type: dict
+    d_types: The datatypes of each column
+        type: dict
+        default: None
+    index: Whether or not to use index
+        type: bool
+        default: False
+    chunk_size: Number of rows to send at a time
+        type: int
+        default: None (100000)
+    key_cols: Lookup columns to index when the table is created
+        type: list
+        default: None
+    date_col: Datetime column to index when the table is created
+        type: str
+        default: None
+    returns: Nothing, pushes data to database table
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Example:
+    copy_to_db(df, 'Waze', get_params())
+    """
+
+    import traceback
+    from generic.db_pool import get_connection
+
+    if index:
+        df = df.reset_index()
+
+    if chunk_size is None:
+        chunk_size = 100000
 
     try:
-        # Connect to database
-        conn = psycopg2.connect(conn_str)
+        # Check out a pooled connection, committed when the block finishes
+        with get_connection(params) as conn:
+            # Create new cursor
+            cursor = conn.cursor()
 
-        # Create new cursor
-        cursor = conn.cursor()
+            exists = check_if_table_exists(cursor, params['schema'], db_table)
+
+            if not exists:
+                create_table(df.head(0), db_table, params, d_types, cursor, key_cols, date_col)
+
+            copy_to_table(cursor, df, params['schema'], db_table, chunk_size)
+
+            cursor.close()
+
+    except:
+        print(traceback.format_exc())
+
+
+def upsert_to_db(df, db_table, params, conflict_cols, on_conflict='update', d_types=None, index=False,
+                 chunk_size=None, key_cols=None, date_col=None):
+    """
+    :Description:
+    Merges data into the selected database table with INSERT ... ON CONFLICT
+    The data is copied to a temporary staging table first, then merged with a single statement
+
+    :Params:
+    df: Data
+        type: pandas DataFrame
+    db_table: The name of the database table
+        type: str
+    params: Database parameters
+        type: dict
+    conflict_cols: Columns that identify a row
+        type: list
+    on_conflict: What to do with rows that already exist
+        type: str
+        options: update - overwrite the other columns
+                 ignore - keep the existing row
+        default: update
+    d_types: The datatypes of each column
+        type: dict
+        default: None
+    index: Whether or not to use index
+        type: bool
+        default: False
+    chunk_size: Number of rows to send at a time
+        type: int
+        default: None (100000)
+    key_cols: Lookup columns to index when the table is created
+        type: list
+        default: None
+    date_col: Datetime column to index when the table is created
+        type: str
+        default: None
+    returns: Nothing, pushes data to database table
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    ON CONFLICT needs a unique index on conflict_cols; it is created with new tables, existing tables need it
+    created once with index_advisor.create_unique_index (dedupe=True drops the duplicates first)
+    If the data itself has duplicates, the last one is kept
+
+    :Example:
+    upsert_to_db(df, 'Waze', get_params(), ['ID', 'Date_Time'])
+    """
+
+    import traceback
+    from generic.db_pool import get_connection
+    from generic.index_advisor import has_unique_index
 
-        n = 0
-        L = len(dd)
-        cols = ', '.join(['"{0}"'.format(i) for i in cols])
+    if on_conflict not in ('update', 'ignore'):
+        raise Exception("on_conflict must be 'update' or 'ignore'")
 
-        if chunk_size is None:
-            chunk_size = L
+    if type(conflict_cols) != list:
+        conflict_cols = [conflict_cols]
 
-        exists = check_if_table_exists(cursor, params['schema'], db_table)
+    if index:
+        df = df.reset_index()
 
-        if not exists:
-            create_table(df.head(0), db_table, params, d_types)
+    if chunk_size is None:
+        chunk_size = 100000
 
-        command = '''INSERT INTO ''' + '{0}."{1}" ({2}) VALUES ('.format(params['schema'], db_table, cols)
+    schema = params['schema']
+    staging = '{0}_staging'.format(db_table)
 
-        while n < L:
-            # Chunk data and convert to string
-            data = "), (".join([", ".join(i) for i in dd[n: n + chunk_size]]) + ')'
+    cols = ', '.join(['"{0}"'.format(i) for i in df.columns])
+    keys = ', '.join(['"{0}"'.format(i) for i in conflict_cols])
 
-            # Execute command
-            cursor.execute(command + data)
+    if on_conflict == 'update':
+        updates = ', '.join(['"{0}" = EXCLUDED."{0}"'.format(i) for i in df.columns if i not in conflict_cols])
+        action = 'DO UPDATE SET ' + updates if updates else 'DO NOTHING'
+    else:
+        action = 'DO NOTHING'
 
-            n += chunk_size
+    # Fail loudly rather than have every merge print the same ON CONFLICT error
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
 
-        # Commit changes to database
-        conn.commit()
+        if check_if_table_exists(cursor, schema, db_table) and \
+                not has_unique_index(cursor, schema, db_table, conflict_cols):
+            raise Exception('{0}."{1}" has no unique index on ({2}), which ON CONFLICT needs; create it once with '
+                            "create_unique_index('{1}', {3}, dedupe=True)".format(schema, db_table, keys,
+                                                                                   conflict_cols))
 
-        # Close connection to database
         cursor.close()
 
+    try:
+        # Check out a pooled connection, committed when the block finishes
+        with get_connection(params) as conn:
+            # Create new cursor
+            cursor = conn.cursor()
+
+            exists = check_if_table_exists(cursor, schema, db_table)
+
+            if not exists:
+                create_table(df.head(0), db_table, params, d_types, cursor, key_cols, date_col)
+
+                # ON CONFLICT needs a unique index on the conflict columns, cheap while the table is empty
+                command = '''CREATE UNIQUE INDEX IF NOT EXISTS ''' + \
+                          '"{0}_{1}_key" ON {2}."{0}" ({3})'.format(db_table, '_'.join(conflict_cols), schema, keys)
+                cursor.execute(command)
+
+            # Staging table only lives until the end of the transaction
+            command = '''CREATE TEMP TABLE ''' + \
+                      '"{0}" (LIKE {1}."{2}" INCLUDING DEFAULTS) ON COMMIT DROP'.format(staging, schema, db_table)
+            cursor.execute(command)
+
+            copy_to_table(cursor, df, 'pg_temp', staging, chunk_size)
+
+            # Merge, keeping the last copy of rows duplicated in the data
+            command = '''INSERT INTO ''' + \
+                      '{0}."{1}" ({2}) SELECT DISTINCT ON ({3}) {2} FROM pg_temp."{4}" ' \
+                      'ORDER BY {3}, ctid DESC ON CONFLICT ({3}) {5}'.format(schema, db_table, cols, keys, staging,
+                                                                             action)
+            cursor.execute(command)
+
+            print('{0} rows merged into {1}."{2}"'.format(cursor.rowcount, schema, db_table))
+
+            cursor.close()
+
     except:
         print(traceback.format_exc())
-    finally:
-        # Make sure connection to database is closed
-        if conn is not None:
-            conn.close()
 
 
 if __name__ == '__main__':
@@ -14,8 +14,10 @@ Update Database Cell
 """
 
 from generic.get_params import get_params
+from generic.db_profiler import profiled
 
 
+@profiled
 def update_db_cell(db_table=None, new_value=None, new_column=None, column_values=None, update_all=False, indent='',
                    *args, **kwargs):
     """
@@ -57,7 +59,7 @@ def update_db_cell(db_table=None, new_value=None, new_column=None, column_values
     update_internal_status_db('automation/waze/some_script', 'VM1', True, 'Something went wrong...script failed')
     """
 
-    from psycopg2 import connect
+    from generic.db_pool import get_connection
 
     params = get_params(*args, **kwargs)
 
@@ -70,63 +72,141 @@ def update_db_cell(db_table=None, new_value=None, new_column=None, column_values
 
     command = '''SELECT COUNT(*) FROM ''' + '{0}."{1}" WHERE {2}'.format(params['schema'], db_table, wheres)
 
-    # Assemble the database metadata
-    conn_str = "host='{0}' dbname='{1}' port='{2}' user='{3}' password='{4}'".format(params['host'],
-                                                                                     params['database'],
-                                                                                     params['port'],
-                                                                                     params['username'],
-                                                                                     params['password'])
+    # Check out a pooled connection, committed when the block finishes
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
 
-    # Connect to database
-    conn = connect(conn_str)
-    cursor = conn.cursor()
+        cursor.execute(command)
 
-    cursor.execute(command)
-    conn.commit()
+        records = cursor.fetchall()
+        num = records[0][0]
 
-    records = cursor.fetchall()
-    num = records[0][0]
+        if num == 1:
 
-    if num == 1:
+            if new_value is not None:
+                command = '''UPDATE ''' + '{0}."{1}" SET "{2}" = \'{3}\' WHERE {4}'.format(params['schema'],
+                                                                                           db_table, new_column,
+                                                                                           new_value, wheres)
+                msg = 'Value updated'
+            else:
+                command = '''DELETE FROM ''' + '{0}."{1}" WHERE {2}'.format(params['schema'], db_table, wheres)
+                msg = 'Row deleted'
 
-        if new_value is not None:
-            command = '''UPDATE ''' + '{0}."{1}" SET "{2}" = \'{3}\' WHERE {4}'.format(params['schema'], db_table,
-                                                                                       new_column, new_value, wheres)
-            msg = 'Value updated'
-        else:
-            command = '''DELETE FROM ''' + '{0}."{1}" WHERE {2}'.format(params['schema'], db_table, wheres)
-            msg = 'Row deleted'
+            # Execute command
+            cursor.execute(command)
 
-        # Execute command
-        cursor.execute(command)
-        conn.commit()
+            print(indent + msg)
+
+        elif num == 0:
+
+            print(indent + 'Location not found')
 
-        print(indent + msg)
+        elif (num > 1) & update_all:
 
-    elif num == 0:
+            if new_value is not None:
+                command = '''UPDATE ''' + '{0}."{1}" SET "{2}" = \'{3}\' WHERE {4}'.format(params['schema'],
+                                                                                           db_table, new_column,
+                                                                                           new_value, wheres)
+                msg = 'All values updated'
+            else:
+                command = '''DELETE FROM ''' + '{0}."{1}" WHERE {2}'.format(params['schema'], db_table, wheres)
+                msg = 'All rows deleted'
 
-        print(indent + 'Location not found')
+            # Execute command
+            cursor.execute(command)
 
-    elif (num > 1) & update_all:
+            print(indent + msg)
 
-        if new_value is not None:
-            command = '''UPDATE ''' + '{0}."{1}" SET "{2}" = \'{3}\' WHERE {4}'.format(params['schema'], db_table,
-                                                                                       new_column, new_value, wheres)
-            msg = 'All values updated'
         else:
-            command = '''DELETE FROM ''' + '{0}."{1}" WHERE {2}'.format(params['schema'], db_table, wheres)
-            msg = 'All rows deleted'
+            print(indent + 'Multiple locations found. Be more specific or set "update_all=True" to update value in all locations.')
 
-        # Execute command
-        cursor.execute(command)
-        conn.commit()
 
-        print(indent + msg)
+@profiled
+def update_db_cells(df=None, key_cols=None, value_cols=None, db_table=None, update_all=False, indent='',
+                    *args, **kwargs):
+    """
+    :Description:
+    Updates many cells of a database table in one round trip
+
+    :Params:
+    df: New values, one row per location
+        type: pandas DataFrame
+    key_cols: Columns to match
+        type: list
+    value_cols: Columns to update
+        type: list
+    db_table: Name of the database table
+        type: str
+        default: None
+    update_all: Update every row matching the keys?
+        type: bool
+        default: False
+    returns: Number of matching rows for each location and whether it was updated
+        type: pandas DataFrame
+        format: key_cols + ['matches', 'updated']
+
+    :Dependencies:
+    Python3
+    pandas
+    psycopg2
+
+    :Notes:
+    The rows are sent as JSON and typed with json_populate_recordset, so the values get the column types of the table
+    The match counts and the update run in a single statement
+    As in update_db_cell, locations with more than one match are only updated with update_all=True
+    Each location should appear only once in df
+
+    :Example:
+    update_db_cells(df, key_cols=['script', 'location'], value_cols=['flag'], db_table='internal_status_dashboard')
+    """
+
+    import pandas as pd
+    from generic.db_pool import get_connection
+
+    params = get_params(*args, **kwargs)
+
+    if type(key_cols) != list:
+        key_cols = [key_cols]
+    if type(value_cols) != list:
+        value_cols = [value_cols]
 
+    data = df[key_cols + value_cols].to_json(orient='records', date_format='iso')
+
+    keys = ', '.join(['v."{0}"'.format(i) for i in key_cols])
+    joins = ' AND '.join(['t."{0}" = v."{0}"'.format(i) for i in key_cols])
+    matches = ' AND '.join(['m."{0}" = v."{0}"'.format(i) for i in key_cols])
+    sets = ', '.join(['"{0}" = v."{0}"'.format(i) for i in value_cols])
+
+    if update_all:
+        allowed = 'm.matches >= 1'
     else:
-        print(indent + 'Multiple locations found. Be more specific or set "update_all=True" to update value in all locations.')
+        allowed = 'm.matches = 1'
+
+    # Count the matches of every location, then update the unambiguous ones
+    command = '''WITH v AS (SELECT * FROM json_populate_recordset(NULL::''' + \
+              '{0}."{1}", %s)), ' \
+              'm AS (SELECT {2}, COUNT(t.ctid) AS matches FROM v LEFT JOIN {0}."{1}" t ON {3} GROUP BY {2}), ' \
+              'u AS (UPDATE {0}."{1}" t SET {4} FROM v JOIN m ON {5} WHERE {3} AND {6} RETURNING 1) ' \
+              'SELECT m.*, {6} AS updated FROM m'.format(params['schema'], db_table, keys, joins, sets, matches,
+                                                         allowed)
+
+    # Check out a pooled connection, committed when the block finishes
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(command, (data,))
+
+        records = cursor.fetchall()
+
+    result = pd.DataFrame(records, columns=key_cols + ['matches', 'updated'])
+
+    print(indent + '{0} locations updated'.format(result.updated.sum()))
+
+    if (~result.updated).any():
+        print(indent + '{0} locations not found, {1} with multiple matches'.format((result.matches == 0).sum(),
+                                                                               (result.matches > 1).sum()))
 
-    conn.close()
+    return result
 
 
 if __name__ == '__main__':
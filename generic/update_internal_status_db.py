@@ -14,6 +14,10 @@ Update Internal Status Dashboard
 """
 
 from generic.get_params import get_params
+from generic.db_profiler import profiled
+
+# Tables found without the unique (script, location) index, written with UPDATE + INSERT instead
+unindexed = set()
 
 
 def update_internal_status_db(script, location, flag, description, date=None, db_table='internal_status_dashboard',
@@ -45,89 +49,125 @@ def update_internal_status_db(script, location, flag, description, date=None, db
 
     :Dependencies:
     Python3
-    pandas
+    psycopg2
+
+    :Notes:
+    The status is inserted or updated with a single INSERT ... ON CONFLICT (script, location) statement
 
     :Example:
     update_internal_status_db('automation/waze/some_script', 'VM1', True, 'Something went wrong...script failed')
     """
 
-    from time import gmtime, strftime
+    statuses = [{'script': script, 'location': location, 'flag': flag, 'description': description, 'date': date}]
+
+    update_internal_status_db_batch(statuses, db_table, *args, **kwargs)
+
+
+@profiled
+def update_internal_status_db_batch(statuses, db_table='internal_status_dashboard', *args, **kwargs):
+    """
+    :Description:
+    Pushes the status of many scripts to the internal status dashboard database table at once
+
+    :Params:
+    statuses: Status of each script
+        type: list
+        format: [{'script': script, 'location': location, 'flag': flag, 'description': description,
+                  'date': date}, ...]
+    db_table: Name of the database table
+        type: str
+        default: internal_status_dashboard
+    returns: Nothing, updates the internal status dashboard database table
+
+    :Dependencies:
+    Python3
+    psycopg2
+
+    :Notes:
+    date is optional and defaults to the current UTC time
+    If a script/location appears more than once, the last status is kept
+    All statuses are sent in one round trip with INSERT ... ON CONFLICT (script, location)
+    That needs a unique index on (script, location), created once with
+    index_advisor.create_unique_index('internal_status_dashboard', ['script', 'location'], dedupe=True)
+    Until then, the statuses are written with an UPDATE of the existing rows and an INSERT of the new ones
+
+    :Example:
+    update_internal_status_db_batch([{'script': 'automation/waze/a', 'location': 'VM1', 'flag': False,
+                                      'description': ''},
+                                     {'script': 'automation/waze/b', 'location': 'VM1', 'flag': True,
+                                      'description': 'Something went wrong...script failed'}])
+    """
+
     from datetime import datetime
-    from psycopg2 import connect
+    from psycopg2 import ProgrammingError
+    from psycopg2.extras import execute_values
+    from generic.db_pool import get_connection
 
     params = get_params(*args, **kwargs)
 
     # Grab the current UTC date
-    if date is None:
-        date = gmtime()
-        date = strftime('%Y-%m-%d %H:%M:%S', date)
-        date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
-
-    print(date)
-
-    # Convert the flag to a string
-    if flag:
-        flag = 'FLAG'
-    else:
-        flag = ''
+    now = datetime.utcnow().replace(microsecond=0)
 
-    # Assemble the database metadata
-    conn_str = "host='{0}' dbname='{1}' port='{2}' user='{3}' password='{4}'".format(params['host'],
-                                                                                     params['database'],
-                                                                                     params['port'],
-                                                                                     params['username'],
-                                                                                     params['password'])
+    # Keep the last status of each script/location
+    rows = {}
+    for i in statuses:
+        date = i.get('date')
+        if date is None:
+            date = now
 
-    # Connect to database
-    conn = connect(conn_str)
-    cursor = conn.cursor()
+        # Convert the flag to a string
+        if i['flag']:
+            flag = 'FLAG'
+        else:
+            flag = ''
 
-    command = '''SELECT COUNT(*) FROM ''' + \
-              "{0}.\"{1}\" WHERE \"location\" LIKE '{2}' AND script LIKE '{3}'".format(params['schema'], db_table,
-                                                                                       location, script)
+        rows[(i['script'], i['location'])] = (i['script'], i['location'], flag, i['description'], date)
 
-    cursor.execute(command)
-    conn.commit()
+    print(now)
 
-    records = cursor.fetchall()
-    num = records[0][0]
+    schema = params['schema']
+    rows = list(rows.values())
 
-    # Will fail if script doesn't exist in table yet
-    if num == 1:
-        # Update flag
-        command = '''UPDATE ''' + '{0}."{1}" SET "flag"'.format(params['schema'], db_table) + \
-                  " = '{0}' WHERE \"location\" LIKE '{1}' AND script LIKE '{2}'".format(flag, location, script)
+    if (schema, db_table) not in unindexed:
+        command = '''INSERT INTO ''' + \
+                  '{0}."{1}" ("script", "location", "flag", "description", "date_time") VALUES %s ' \
+                  'ON CONFLICT ("script", "location") DO UPDATE SET "flag" = EXCLUDED."flag", ' \
+                  '"description" = EXCLUDED."description", "date_time" = EXCLUDED."date_time"'.format(schema,
+                                                                                                      db_table)
 
-        cursor.execute(command)
-        conn.commit()
+        try:
+            # Check out a pooled connection, committed when the block finishes
+            with get_connection(params) as conn:
+                cursor = conn.cursor()
 
-        # Update description
-        command = '''UPDATE ''' + '{0}."{1}" SET "description"'.format(params['schema'], db_table) + \
-                  " = '{0}' WHERE \"location\" LIKE '{1}' AND script LIKE '{2}'".format(description, location, script)
+                execute_values(cursor, command, rows, page_size=max(len(rows), 1))
 
-        cursor.execute(command)
-        conn.commit()
+            return
+        except ProgrammingError as e:
+            # 42P10: no unique index matching the ON CONFLICT columns
+            if e.pgcode != '42P10':
+                raise
 
-        # Update date_time
-        command = '''UPDATE ''' + '{0}."{1}" SET "date_time"'.format(params['schema'], db_table) + \
-                  " = '{0}' WHERE \"location\" LIKE '{1}' AND script LIKE '{2}'".format(date, location, script)
+            print('{0}."{1}" has no unique index on ("script", "location"), '
+                  'see index_advisor.create_unique_index'.format(schema, db_table))
+            unindexed.add((schema, db_table))
 
-        # Execute command
-        cursor.execute(command)
-        conn.commit()
+    values = '(VALUES %s) AS v ("script", "location", "flag", "description", "date_time")'
 
-    elif num == 0:
-        print('script doesnt exist yet')
-        from generic.to_db import to_db
-        import pandas as pd
+    update = '''UPDATE ''' + \
+             '{0}."{1}" AS t SET "flag" = v."flag", "description" = v."description", "date_time" = v."date_time" ' \
+             'FROM {2} WHERE t."script" = v."script" AND t."location" = v."location"'.format(schema, db_table, values)
 
-        df = pd.DataFrame({'script': script, 'date_time': date, 'location': location, 'flag': flag,
-                           'description': description}, index=[0])
+    insert = '''INSERT INTO ''' + \
+             '{0}."{1}" ("script", "location", "flag", "description", "date_time") SELECT v.* FROM {2} ' \
+             'WHERE NOT EXISTS (SELECT 1 FROM {0}."{1}" AS t WHERE t."script" = v."script" ' \
+             'AND t."location" = v."location")'.format(schema, db_table, values)
 
-        # Push new status to database
-        to_db(df, db_table)
+    with get_connection(params) as conn:
+        cursor = conn.cursor()
 
-    conn.close()
+        execute_values(cursor, update, rows, page_size=max(len(rows), 1))
+        execute_values(cursor, insert, rows, page_size=max(len(rows), 1))
 
 
 if __name__ == '__main__':
@@ -29,8 +29,8 @@ from bokeh.models import WheelZoomTool, ColumnDataSource, HoverTool, CrosshairTo
 from bokeh.transform import linear_cmap
 
 from generic.notifier import notifier
-from generic.load_data import load_data
-from generic.geospatial import get_coords, to_xy, lat_to_y, lon_to_x
+from generic.load_data import load_data, load_new_data
+from generic.geospatial import project_geometries, lat_to_y, lon_to_x
 
 pd.set_option('mode.chained_assignment', None)
 
@@ -69,7 +69,7 @@ def get_data(first=False, recipients=None):
 
         dfs = []
         for s, e, n in zip(starts[:1], ends[:1], [0]):
-            temp = load_data('waze_api', s, e, date_col='Date_Time', time_zone='America/New_York', chunk_size=999999999)
+            temp = load_data('waze_api', s, e, date_col='Date_Time', time_zone='America/New_York', stream=True)
 
             # temp.Date_Time = temp.Date_Time + pd.Timedelta(weeks=n)
             temp.Date_Time = temp.Date_Time.dt.tz_convert('America/New_York').dt.tz_localize(None)
@@ -82,7 +82,7 @@ def get_data(first=False, recipients=None):
             dfs.append(temp)
 
         for s, e, n in zip(starts[1:], ends[1:], [1, 2, 3, 4]):
-            # temp = load_data('waze_api', s, e, date_col='Date_Time', time_zone='America/New_York', chunk_size=999999999)
+            # temp = load_data('waze_api', s, e, date_col='Date_Time', time_zone='America/New_York', stream=True)
 
             s = ''.join(s.split('-')).split()[0]
             try:
@@ -111,10 +111,10 @@ def get_data(first=False, recipients=None):
 
     else:
 
-        # GRAB ALL DATA FROM WAZE TABLE
+        # GRAB NEW DATA FROM WAZE TABLE
 
-        df = load_data('waze_api', datetime.strftime(today, '%Y-%m-%d %H:%M:%S'), date_col='Date_Time',
-                       time_zone='America/New_York', chunk_size=999999999)
+        df = load_new_data('waze_api', datetime.strftime(today, '%Y-%m-%d %H:%M:%S'), date_col='Date_Time',
+                           key_col='ID', time_zone='America/New_York')
 
         df.Date_Time = df.Date_Time.dt.tz_convert('America/New_York').dt.tz_localize(None)
 
@@ -130,11 +130,8 @@ def load_shape(fn='waze_routes.txt'):
 
     gdf['geometry'] = gdf['geometry'].to_crs(epsg=4326)
 
-    gdf['x'] = gdf.apply(get_coords, geom_col='geometry', coord_type='x', axis=1)
-    gdf['y'] = gdf.apply(get_coords, geom_col='geometry', coord_type='y', axis=1)
-
-    gdf['x'] = gdf['x'].apply(to_xy, coord='lon')
-    gdf['y'] = gdf['y'].apply(to_xy, coord='lat')
+    # Project every vertex at once
+    gdf['x'], gdf['y'] = project_geometries(gdf['geometry'])
 
     gdf.drop('geometry', 1, inplace=True)
 